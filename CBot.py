@@ -8,20 +8,48 @@
 # - دکمه Contact فقط در مرحله‌ی خودش و سپس بازگشت به کیبورد اصلی
 
 import os
+import io
+import csv
 import json
+import time
+import asyncio
+import contextvars
+import socket
+import sqlite3
+import heapq
+import hmac
+import itertools
+import random
+import bisect
+import functools
+import threading
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+from collections import deque, OrderedDict
 from datetime import datetime
+from zoneinfo import ZoneInfo
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Request
+STARTUP_T0 = time.perf_counter()  # before the heavy third-party imports below
+
+import httpx
+from fastapi import FastAPI, Request, Response, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from telegram import (
-    Update,
+    Update, TelegramObject,
     InlineKeyboardButton, InlineKeyboardMarkup,
     ReplyKeyboardMarkup, KeyboardButton,
 )
 from telegram.ext import (
     ApplicationBuilder, ContextTypes, CommandHandler,
     CallbackQueryHandler, MessageHandler, filters,
+    BasePersistence, PersistenceInput, BaseRateLimiter,
+    TypeHandler, ApplicationHandlerStop,
 )
+from telegram.error import RetryAfter, Forbidden
+from telegram.request import HTTPXRequest
 
 # =========================
 #        SETTINGS
@@ -29,13 +57,82 @@ from telegram.ext import (
 BOT_TOKEN = os.environ.get("BOT_TOKEN")                       # REQUIRED
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL")                   # REQUIRED (e.g. https://your-app.onrender.com)
 GROUP_CHAT_ID = int(os.environ.get("GROUP_CHAT_ID", "0"))     # admin group/channel id (negative for groups)
+BOT_API_BASE_URL = os.environ.get("BOT_API_BASE_URL")         # e.g. local Bot API server / fake API for benchmarks
+# "check": set_webhook only if Telegram has another URL | "background": same, after serving starts
+# (fastest cold start) | "always": set on every boot | "off"
+WEBHOOK_SETUP = os.environ.get("WEBHOOK_SETUP", "check")
 
 # OPTIONAL: Google Sheets (kept off by default; don't set creds to disable)
 GSPREAD_CREDS_JSON = os.environ.get("GSPREAD_CREDS_JSON")     # JSON string or None
 SHEET_NAME = os.environ.get("SHEET_NAME", "EnglishClubRegistrations")
+SHEET_BACKEND = os.environ.get("SHEET_BACKEND", "gspread")          # "gspread" | "local" (CSV stand-in for dev/tests)
+SHEET_LOCAL_PATH = os.environ.get("SHEET_LOCAL_PATH", "sheet_rows.csv")
+SHEET_SPOOL_PATH = os.environ.get("SHEET_SPOOL_PATH", "sheet_spool.jsonl")  # unsent rows survive restarts
+SHEET_BATCH_SIZE = max(1, int(os.environ.get("SHEET_BATCH_SIZE", "20")))
+SHEET_FLUSH_INTERVAL = float(os.environ.get("SHEET_FLUSH_INTERVAL", "5"))   # seconds
+
+EVENTS_PAGE_SIZE = max(1, min(90, int(os.environ.get("EVENTS_PAGE_SIZE", "8"))))  # event buttons per message
+
+# Multi-process mode (start.sh with CBOT_WORKERS > 1): router.py sends each chat to one of
+# CBOT_WORKERS bot processes (chat_id % CBOT_WORKERS); CBOT_WORKER_ID is this process' index
+CBOT_WORKERS = max(1, int(os.environ.get("CBOT_WORKERS", "1")))
+CBOT_WORKER_ID = int(os.environ.get("CBOT_WORKER_ID", "0"))
+SEND_BUDGET_INTERVAL = float(os.environ.get("SEND_BUDGET_INTERVAL", "1"))  # seconds between send budget leases
+
+# Webhook processing: "1" = ack immediately and process via in-process queue, "0" = inline
+WEBHOOK_ASYNC = os.environ.get("WEBHOOK_ASYNC", "1") == "1"
+UPDATE_WORKERS = max(1, int(os.environ.get("UPDATE_WORKERS", "8")))          # worker tasks (chat shards)
+UPDATE_QUEUE_SIZE = max(1, int(os.environ.get("UPDATE_QUEUE_SIZE", "2000")))  # total capacity over all shards
+
+# Outgoing flood control (Telegram: ~30 msg/s overall, ~1 msg/s per private chat, 20 msg/min per group)
+SEND_RATE_LIMIT = os.environ.get("SEND_RATE_LIMIT", "1") == "1"
+SEND_GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", "30"))          # messages / second
+SEND_PRIVATE_CHAT_RATE = float(os.environ.get("SEND_PRIVATE_CHAT_RATE", "1"))  # messages / second / chat
+SEND_GROUP_CHAT_RATE = float(os.environ.get("SEND_GROUP_CHAT_RATE", "0.33"))   # messages / second / group
+SEND_COALESCE = os.environ.get("SEND_COALESCE", "1") == "1"                 # merge queued plain texts per chat
+
+# Broadcasts to approved participants (/broadcast <event_id> <message>)
+BROADCAST_CONCURRENCY = max(1, int(os.environ.get("BROADCAST_CONCURRENCY", "8")))
+BROADCAST_CHECKPOINT_EVERY = max(1, int(os.environ.get("BROADCAST_CHECKPOINT_EVERY", "20")))
+
+# Reminders before each event for approved participants
+REMINDERS_ENABLED = os.environ.get("REMINDERS", "1") == "1"
+REMINDER_OFFSETS = os.environ.get("REMINDER_OFFSETS", "24h,1h")     # comma separated: 30m, 1h, 2d
+EVENT_TIMEZONE = os.environ.get("EVENT_TIMEZONE", "UTC")            # timezone of event `when` strings
+EVENT_TIME_FORMAT = os.environ.get("EVENT_TIME_FORMAT", "%Y-%m-%d %H:%M")
+
+# Redelivered webhook updates are dropped by update_id (shared via SQLite when STATE_BACKEND=sqlite)
+UPDATE_DEDUP_SIZE = max(1, int(os.environ.get("UPDATE_DEDUP_SIZE", "20000")))
+UPDATE_DEDUP_TTL = float(os.environ.get("UPDATE_DEDUP_TTL", "86400"))  # Telegram keeps retrying up to 24h
+
+# Sessions: idle users' user_data (nav stack + half-filled answers) is dropped after SESSION_TTL,
+# and at most SESSION_MAX users are kept (least recently active evicted first)
+SESSION_TTL = float(os.environ.get("SESSION_TTL", "21600"))                 # seconds of inactivity
+SESSION_MAX = max(1, int(os.environ.get("SESSION_MAX", "20000")))
+SESSION_SWEEP_INTERVAL = float(os.environ.get("SESSION_SWEEP_INTERVAL", "60"))  # seconds between sweeps
+
+# Outbox: admin cards and decision messages are stored before sending, then delivered with retries
+OUTBOX_BATCH = max(1, int(os.environ.get("OUTBOX_BATCH", "50")))               # rows claimed per round
+OUTBOX_MAX_ATTEMPTS = max(1, int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "12")))
+OUTBOX_MAX_BACKOFF = float(os.environ.get("OUTBOX_MAX_BACKOFF", "600"))       # seconds
+
+# Bulk review (/review <event_id> [N]): pending registrations per digest page, default N for "first N"
+REVIEW_PAGE_SIZE = max(1, min(20, int(os.environ.get("REVIEW_PAGE_SIZE", "10"))))
+REVIEW_FIRST_N = max(1, int(os.environ.get("REVIEW_FIRST_N", "10")))
+
+# Conversation tables (/tables <event_id> [size]): seats per table
+TABLE_SIZE = max(2, int(os.environ.get("TABLE_SIZE", "6")))
+
+# Country code for numbers typed in national form (0912...); phones are stored as E.164
+PHONE_COUNTRY_CODE = os.environ.get("PHONE_COUNTRY_CODE", "98").lstrip("+")
+
+# Local storage (SQLite, WAL) shared by all worker processes on this machine
+DB_PATH = os.environ.get("CBOT_DB_PATH", "cbot.sqlite3")
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "sqlite")                    # "sqlite" | "memory"
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", "1"))     # seconds between batched writes
 
 # EVENTS & LINKS
-# Each event may contain: id, title, when, place, maps, price, desc
+# Each event may contain: id, title, when, place, maps, price, desc, capacity (optional seat limit)
 DEFAULT_EVENTS = [
     {
         "id": "m1",
@@ -59,10 +156,62 @@ try:
 except Exception:
     MEETUP_LINKS = {}
 
+# Hot-reloadable catalog source (overrides EVENTS_JSON/MEETUP_LINKS_JSON when set):
+# - *.json: a list of events, or {"version": ..., "events": [...], "links": {event_id: url}}
+# - *.db / *.sqlite / *.sqlite3: tables `events` (id, title, "when", place, maps, price, desc)
+#   and optional `meetup_links` (event_id, link); PRAGMA user_version is the catalog version
+EVENTS_SOURCE = os.environ.get("EVENTS_SOURCE")
+EVENTS_RELOAD_INTERVAL = float(os.environ.get("EVENTS_RELOAD_INTERVAL", "10"))  # seconds between mtime checks
+
+# Admins allowed to run admin commands in private chat (comma separated user ids);
+# anyone in GROUP_CHAT_ID is treated as admin as well
+ADMIN_IDS = {int(x) for x in os.environ.get("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+# Dashboard endpoints (/admin/...) need "Authorization: Bearer <token>"; unset = endpoints disabled
+ADMIN_API_TOKEN = os.environ.get("ADMIN_API_TOKEN")
+STATS_CACHE_TTL = float(os.environ.get("STATS_CACHE_TTL", "2"))  # seconds a stats snapshot is served from memory
+# Chats whose last rendered message is remembered, so identical re-renders skip the edit call.
+# The cache is per process: it is only correct while all of a chat's updates reach one process
+# (single process, or router.py with CBOT_WORKERS). uvicorn --workers (WEB_CONCURRENCY > 1,
+# also read by uvicorn itself) spreads a chat over processes, so it is turned off there.
+WEB_CONCURRENCY = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "10000")) if WEB_CONCURRENCY == 1 else 0
+
 # =========================
 #        CONSTANT TEXTS
 # =========================
-reply_main = ReplyKeyboardMarkup([["شروع مجدد 🔄"]], resize_keyboard=True)
+class StaticMarkup:
+    """Keyboard that never changes after construction: its dict/JSON form is built once.
+
+    PTB calls to_dict() on every send, walking every button (~50µs for the main menu).
+    """
+    __slots__ = ()
+
+    def _freeze_json(self):
+        with self._unfrozen():
+            self._dict = super().to_dict()
+            self._json = json.dumps(self._dict)
+
+    def to_dict(self, recursive=True):
+        return self._dict if recursive else super().to_dict(recursive)
+
+    def to_json(self):
+        return self._json
+
+class StaticInlineMarkup(StaticMarkup, InlineKeyboardMarkup):
+    __slots__ = ("_dict", "_json")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._freeze_json()
+
+class StaticReplyMarkup(StaticMarkup, ReplyKeyboardMarkup):
+    __slots__ = ("_dict", "_json")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._freeze_json()
+
+reply_main = StaticReplyMarkup([["شروع مجدد 🔄"]], resize_keyboard=True)
 
 welcome_text = (
     "سلام! به ربات *English Club* خوش اومدی 🇬🇧☕\n"
@@ -84,10 +233,294 @@ rules_text = (
     "• اگر منصرف شدی زودتر خبر بده."
 )
 
+# =========================
+#         METRICS
+# =========================
+# Minimal Prometheus text-format registry (no extra dependency). Label values are
+# tuples in a dict, bucket lookup is a bisect, so observing costs ~1µs.
+class Metric:
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        METRICS.append(self)
+
+    @staticmethod
+    def _escape(value):
+        # exposition format: backslash, double quote and newline are escaped in label values
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def _fmt_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{self._escape(v)}"' for k, v in pairs) + "}"
+
+class CounterMetric(Metric):
+    kind = "counter"
+
+    def inc(self, *key, n=1):
+        self.values[key] = self.values.get(key, 0) + n
+
+    def render(self):
+        return [f"{self.name}{self._fmt_labels(k)} {v}" for k, v in self.values.items()]
+
+class GaugeMetric(Metric):
+    """Value is read from a callback at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, name, doc, fn):
+        super().__init__(name, doc)
+        self.fn = fn
+
+    def render(self):
+        try:
+            return [f"{self.name} {self.fn()}"]
+        except Exception:
+            return []
+
+class CallbackCounterMetric(GaugeMetric):
+    """Counter whose total is read from a callback (an existing running count) at scrape time."""
+    kind = "counter"
+
+class _Timer:
+    __slots__ = ("hist", "key", "t0")
+
+    def __init__(self, hist, key):
+        self.hist = hist
+        self.key = key
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.t0, *self.key)
+        return False
+
+class HistogramMetric(Metric):
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *key):
+        v = self.values.get(key)
+        if v is None:
+            v = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        v[0][bisect.bisect_left(self.buckets, value)] += 1
+        v[1] += value
+        v[2] += 1
+
+    def time(self, *key):
+        return _Timer(self, key)
+
+    def render(self):
+        out = []
+        for key, (counts, total, n) in self.values.items():
+            acc = 0
+            for le, c in zip(self.buckets, counts):
+                acc += c
+                out.append(f"{self.name}_bucket{self._fmt_labels(key, [('le', le)])} {acc}")
+            out.append(f"{self.name}_bucket{self._fmt_labels(key, [('le', '+Inf')])} {n}")
+            out.append(f"{self.name}_sum{self._fmt_labels(key)} {total}")
+            out.append(f"{self.name}_count{self._fmt_labels(key)} {n}")
+        return out
+
+METRICS = []
+
+class StartupTimer:
+    """Boot breakdown: milliseconds spent in each phase since the previous mark."""
+    def __init__(self, t0):
+        self.t0 = self.last = t0
+        self.phases = {}
+        self.ready_ms = None
+        self.first_update_ms = None  # process start -> first webhook update received
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = round((now - self.last) * 1000, 1)
+        self.last = now
+
+    def since_start(self):
+        return round((time.perf_counter() - self.t0) * 1000, 1)
+
+    def ready(self):
+        self.ready_ms = self.since_start()
+        print("Startup: " + ", ".join(f"{k}={v}ms" for k, v in self.phases.items()) + f" | ready={self.ready_ms}ms")
+
+    def report(self):
+        return {"phases_ms": self.phases, "ready_ms": self.ready_ms, "first_update_ms": self.first_update_ms}
+
+STARTUP = StartupTimer(STARTUP_T0)
+STARTUP.mark("imports")
+
+def render_metrics():
+    lines = []
+    for m in METRICS:
+        lines.append(f"# HELP {m.name} {m.doc}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+HANDLER_SECONDS = HistogramMetric("cbot_handler_seconds", "Handler latency", ("handler", "key"))
+HANDLER_ERRORS = CounterMetric("cbot_handler_errors_total", "Exceptions raised by handlers", ("handler",))
+BOT_API_SECONDS = HistogramMetric("cbot_bot_api_seconds", "Outbound Bot API call latency", ("method", "code"))
+FUNNEL = CounterMetric("cbot_funnel_total", "Registration funnel: users entering each step", ("step",))
+
+def callback_key(data):
+    # bounded label set (callback data comes from clients): exact names for static buttons,
+    # the prefix for parametrised ones, "other" for anything no route knows
+    data = data or ""
+    if data in CALLBACK_ROUTES:
+        return data
+    prefix = data.split("_", 1)[0]
+    return prefix if prefix in PREFIX_ROUTES else "other"
+
+def timed_handler(key_fn=None):
+    """Times a handler into cbot_handler_seconds{handler, key}; key_fn(update, context) picks the key."""
+    def deco(fn):
+        name = fn.__name__
+
+        @functools.wraps(fn)
+        async def wrapper(update, context, *args, **kwargs):
+            key = key_fn(update, context) if key_fn else ""
+            t0 = time.perf_counter()
+            try:
+                return await fn(update, context, *args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(name)
+                raise
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - t0, name, key or "")
+        return wrapper
+    return deco
+
+@functools.lru_cache(maxsize=None)
+def shared_ssl_context():
+    # loading the CA bundle costs ~30ms; do it once for all request objects
+    return httpx.create_ssl_context()
+
+RENDER_SAVED = CounterMetric("cbot_render_saved_total", "Bot API calls saved by the render cache", ("method", "reason"))
+
+class RenderCache:
+    """Last message rendered per chat: message id, text fingerprint, keyboard JSON, API response.
+
+    Navigation re-renders the same screen a lot (home, event list, back to a step). An edit
+    whose text and keyboard equal what the message already shows is answered from here
+    without a Bot API call, and Telegram's "message is not modified" error becomes a success.
+    Values are compared in wire form (the JSON PTB would send), so both the rate limiter
+    (Python objects) and the request layer (serialized parameters) can ask.
+    """
+    EDITS = ("editMessageText", "editMessageReplyMarkup")
+    TRACKED = ("sendMessage", "editMessage", "deleteMessage")  # method prefixes that touch chat messages
+    TRUE = b'{"ok":true,"result":true}'  # what Telegram returns for edits without a Message
+
+    def __init__(self, size):
+        self.size = size
+        self.chats = OrderedDict()  # chat_id -> (message_id, text, markup, payload)
+
+    @staticmethod
+    def _wire(value):
+        if value is None or isinstance(value, str):
+            return value
+        if isinstance(value, TelegramObject):
+            return value.to_json()
+        return json.dumps(value, default=lambda o: o.to_dict())
+
+    def _text(self, params):
+        return tuple(self._wire(params.get(k)) for k in ("text", "parse_mode", "entities", "disable_web_page_preview"))
+
+    def lookup(self, method, params):
+        """Cached response if this edit would leave the message as it is, else None."""
+        if method not in self.EDITS or "inline_message_id" in params:
+            return None
+        entry = self.chats.get(str(params.get("chat_id")))
+        if entry is None or entry[0] != str(params.get("message_id")):
+            return None
+        if self._wire(params.get("reply_markup")) != entry[2]:
+            return None
+        if method == "editMessageText" and self._text(params) != entry[1]:
+            return None
+        return entry[3]
+
+    def begin(self, method, params):
+        """Forgets the chat's entry while a call that may change its messages is in flight."""
+        if "chat_id" in params and "message_id" in params or method == "sendMessage":
+            return self.chats.pop(str(params.get("chat_id")), None)
+        return None
+
+    def remember(self, method, params, payload, previous=None):
+        chat = str(params.get("chat_id"))
+        if method == "sendMessage":
+            try:
+                mid = str(json.loads(payload)["result"]["message_id"])
+            except (ValueError, KeyError, TypeError):
+                return
+            text = self._text(params)
+        elif method in self.EDITS and "inline_message_id" not in params:
+            mid = str(params.get("message_id"))
+            if method == "editMessageText":
+                text = self._text(params)
+            else:  # keyboard-only edit: text unchanged if we know it
+                text = previous[1] if previous and previous[0] == mid else None
+        else:
+            return
+        self.chats[chat] = (mid, text, self._wire(params.get("reply_markup")), payload)
+        self.chats.move_to_end(chat)
+        while len(self.chats) > self.size:
+            self.chats.popitem(last=False)
+
+    def stats(self):
+        saved = {}
+        for (method, reason), n in RENDER_SAVED.values.items():
+            saved[reason] = saved.get(reason, 0) + n
+        return {"chats": len(self.chats), **saved}
+
+RENDER_CACHE = RenderCache(RENDER_CACHE_SIZE)
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that times every Bot API call by method and HTTP status.
+
+    Message sends/edits also go through RENDER_CACHE: no-op edits never leave the process.
+    """
+    def _build_client(self):
+        return httpx.AsyncClient(verify=shared_ssl_context(), **self._client_kwargs)
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        tracked = request_data and RENDER_CACHE.size and api_method.startswith(RenderCache.TRACKED)
+        params = request_data.json_parameters if tracked else {}
+        cached = RENDER_CACHE.lookup(api_method, params) if params else None
+        if cached is not None:
+            RENDER_SAVED.inc(api_method, "skipped")
+            return 200, cached
+        previous = RENDER_CACHE.begin(api_method, params) if params else None
+        t0 = time.perf_counter()
+        code = "error"
+        try:
+            code, payload = await super().do_request(url, method, request_data=request_data, **kwargs)
+        finally:
+            BOT_API_SECONDS.observe(time.perf_counter() - t0, api_method, code)
+        if params:
+            if code == 200:
+                RENDER_CACHE.remember(api_method, params, payload, previous)
+            elif code == 400 and api_method in RenderCache.EDITS and b"message is not modified" in payload:
+                # Telegram already shows exactly this; treat it as done
+                RENDER_SAVED.inc(api_method, "not_modified")
+                same = previous and previous[0] == str(params.get("message_id"))
+                code, payload = 200, previous[3] if same else RenderCache.TRUE
+                RENDER_CACHE.remember(api_method, params, payload, previous)
+        return code, payload
+
 # =========================
 #       NAV / HELPERS
 # =========================
 def push_step(context: ContextTypes.DEFAULT_TYPE, step: str):
+    FUNNEL.inc(step)
     nav = context.user_data.get("nav", [])
     nav.append(step)
     context.user_data["nav"] = nav
@@ -104,48 +537,44 @@ def current_step(context: ContextTypes.DEFAULT_TYPE):
     return nav[-1] if nav else None
 
 def clear_flow(context: ContextTypes.DEFAULT_TYPE):
-    keys = ["nav", "selected_event_id", "name", "phone", "level", "note", "origin"]
+    keys = ["nav", "selected_event_id", "origin"] + FLOW_FIELDS
     for k in keys:
         context.user_data.pop(k, None)
 
 def get_event(ev_id):
-    return next((e for e in EVENTS if e.get("id") == ev_id), None)
-
-def build_main_menu():
-    buttons = [
-        [InlineKeyboardButton("🎉 رویدادهای پیش‌رو", callback_data="list_events")],
-        [InlineKeyboardButton("📝 ثبت‌نام", callback_data="register")],
-        [InlineKeyboardButton("❔ سوالات متداول", callback_data="faq")],
-        [InlineKeyboardButton("🆘 پشتیبانی", callback_data="support")],
-    ]
-    return InlineKeyboardMarkup(buttons)
-
-def build_events_buttons(compact=False):
-    rows = []
-    for e in EVENTS:
-        label = f"{e['title']} | {e['when']}" if compact else f"{e['title']} | {e['when']}"
-        rows.append([InlineKeyboardButton(label, callback_data=f"event_{e['id']}")])
-    if not rows:
-        rows = [[InlineKeyboardButton("فعلاً رویدادی ثبت نشده", callback_data="noop")]]
-    rows.append([InlineKeyboardButton("↩️ بازگشت", callback_data="back_home")])
-    return InlineKeyboardMarkup(rows)
-
-def back_inline():
-    return InlineKeyboardMarkup([[InlineKeyboardButton("↩️ بازگشت به مرحله قبل", callback_data="back_step")]])
-
-def rules_inline():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ قبول دارم و بعدی", callback_data="accept_rules")],
-        [InlineKeyboardButton("↩️ بازگشت به مرحله قبل", callback_data="back_step")],
-    ])
+    return CATALOG.get(ev_id)
+
+def is_admin(update: Update):
+    if GROUP_CHAT_ID and update.effective_chat and update.effective_chat.id == GROUP_CHAT_ID:
+        return True
+    return bool(update.effective_user and update.effective_user.id in ADMIN_IDS)
+
+# Static keyboards: built (and serialized) once at import, shared by every reply
+MAIN_MENU = StaticInlineMarkup([
+    [InlineKeyboardButton("🎉 رویدادهای پیش‌رو", callback_data="list_events")],
+    [InlineKeyboardButton("📝 ثبت‌نام", callback_data="register")],
+    [InlineKeyboardButton("❔ سوالات متداول", callback_data="faq")],
+    [InlineKeyboardButton("🆘 پشتیبانی", callback_data="support")],
+])
+BACK_STEP_INLINE = StaticInlineMarkup([[InlineKeyboardButton("↩️ بازگشت به مرحله قبل", callback_data="back_step")]])
+BACK_HOME_INLINE = StaticInlineMarkup([[InlineKeyboardButton("↩️ بازگشت", callback_data="back_home")]])
+RULES_INLINE = StaticInlineMarkup([
+    [InlineKeyboardButton("✅ قبول دارم و بعدی", callback_data="accept_rules")],
+    [InlineKeyboardButton("↩️ بازگشت به مرحله قبل", callback_data="back_step")],
+])
+LEVEL_INLINE = StaticInlineMarkup([
+    [InlineKeyboardButton("Beginner (A1–A2)", callback_data="lvl_A")],
+    [InlineKeyboardButton("Intermediate (B1–B2)", callback_data="lvl_B")],
+    [InlineKeyboardButton("Advanced (C1+)", callback_data="lvl_C")],
+    [InlineKeyboardButton("↩️ بازگشت به مرحله قبل", callback_data="back_step")],
+])
+CONTACT_KEYBOARD = StaticReplyMarkup(
+    [[KeyboardButton("ارسال شماره تماس 📱", request_contact=True)]],
+    resize_keyboard=True, one_time_keyboard=True,
+)
 
-def level_inline():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("Beginner (A1–A2)", callback_data="lvl_A")],
-        [InlineKeyboardButton("Intermediate (B1–B2)", callback_data="lvl_B")],
-        [InlineKeyboardButton("Advanced (C1+)", callback_data="lvl_C")],
-        [InlineKeyboardButton("↩️ بازگشت به مرحله قبل", callback_data="back_step")],
-    ])
+def build_events_buttons(page=0):
+    return CATALOG.list_markup(page)
 
 def event_detail_text_user(ev):
     # To user: hide place/maps until approved
@@ -171,75 +600,436 @@ def event_detail_text_admin(ev):
         f"📝 {ev.get('desc','—')}"
     )
 
+def event_detail_text_approved(ev, link=None):
+    # To user after approval: now reveal place/maps
+    detail = (
+        "🎉 ثبت‌نامت تایید شد!\n\n"
+        f"📌 {ev.get('title','')}\n"
+        f"🕒 {ev.get('when','')}\n"
+        f"📍 {ev.get('place','—')}\n"
+        f"🗺️ {ev.get('maps','—')}\n"
+        f"💶 {ev.get('price','Free')}\n"
+        f"📝 {ev.get('desc','—')}\n"
+    )
+    if link:
+        detail += f"\n🔗 لینک گروه/هماهنگی:\n{link}"
+    return detail
+
 def event_inline_register(ev_id):
-    return InlineKeyboardMarkup([
+    return StaticInlineMarkup([
         [InlineKeyboardButton("📝 ثبت‌نام در همین رویداد", callback_data=f"register_{ev_id}")],
         [InlineKeyboardButton("↩️ بازگشت", callback_data="list_events")],
     ])
 
+# =========================
+#       EVENT CATALOG
+# =========================
+class EventCatalog:
+    """Events indexed by id and sorted by `when`, with texts/keyboards rendered once.
+
+    All derived data lives in one snapshot dict; replace() builds a new snapshot and
+    swaps the reference, so readers never see a half-updated catalog.
+    """
+    def __init__(self, events, links=None, page_size=EVENTS_PAGE_SIZE):
+        self.page_size = page_size
+        self.version = 0
+        self._snap = self._build(events, links or {})
+
+    def _build(self, events, links, prev=None):
+        ordered = sorted(
+            ({**e, "id": str(e["id"])} for e in events if isinstance(e, dict) and e.get("id")),
+            key=lambda e: (str(e.get("when", "")), str(e["id"])),
+        )
+        by_id = {e["id"]: e for e in ordered}
+        ordered = list(by_id.values())  # last definition wins on duplicate ids
+        snap = {
+            "events": ordered,
+            "by_id": by_id,
+            "links": dict(links),
+            "user_text": {},
+            "admin_text": {},
+            "approved_text": {},
+            "register_markup": {},
+        }
+        for i, e in by_id.items():
+            # incremental: unchanged events keep their already rendered texts/keyboards
+            if prev and prev["by_id"].get(i) == e and prev["links"].get(i) == links.get(i):
+                for k in ("user_text", "admin_text", "approved_text", "register_markup"):
+                    snap[k][i] = prev[k][i]
+                continue
+            snap["user_text"][i] = event_detail_text_user(e)
+            snap["admin_text"][i] = event_detail_text_admin(e)
+            snap["approved_text"][i] = event_detail_text_approved(e, links.get(i))
+            snap["register_markup"][i] = event_inline_register(i)
+        pages = [ordered[i:i + self.page_size] for i in range(0, len(ordered), self.page_size)] or [[]]
+        snap["pages"] = [self._page_markup(p, n, len(pages)) for n, p in enumerate(pages)]
+        return snap
+
+    @staticmethod
+    def _page_markup(events, page, total):
+        rows = [[InlineKeyboardButton(f"{e.get('title','')} | {e.get('when','')}", callback_data=f"event_{e['id']}")] for e in events]
+        if not rows:
+            rows = [[InlineKeyboardButton("فعلاً رویدادی ثبت نشده", callback_data="noop")]]
+        if total > 1:
+            nav = []
+            if page > 0:
+                nav.append(InlineKeyboardButton("◀️ قبلی", callback_data=f"events_page_{page - 1}"))
+            nav.append(InlineKeyboardButton(f"{page + 1}/{total}", callback_data="noop"))
+            if page < total - 1:
+                nav.append(InlineKeyboardButton("بعدی ▶️", callback_data=f"events_page_{page + 1}"))
+            rows.append(nav)
+        rows.append([InlineKeyboardButton("↩️ بازگشت", callback_data="back_home")])
+        return StaticInlineMarkup(rows)  # immutable per catalog snapshot
+
+    def replace(self, events, links=None):
+        """Swap in a new catalog; returns how many events were added/removed/changed."""
+        prev = self._snap
+        snap = self._build(events, prev["links"] if links is None else links, prev)
+        old_ids, new_ids = set(prev["by_id"]), set(snap["by_id"])
+        diff = {
+            "added": len(new_ids - old_ids),
+            "removed": len(old_ids - new_ids),
+            "changed": sum(
+                1 for i in old_ids & new_ids
+                if prev["by_id"][i] != snap["by_id"][i] or prev["links"].get(i) != snap["links"].get(i)
+            ),
+        }
+        if any(diff.values()) or prev["links"] != snap["links"]:
+            self._snap = snap  # single reference swap
+            self.version += 1
+        return diff
+
+    @property
+    def events(self):
+        return self._snap["events"]
+
+    @property
+    def links(self):
+        return self._snap["links"]
+
+    def __len__(self):
+        return len(self._snap["events"])
+
+    def get(self, ev_id):
+        return self._snap["by_id"].get(str(ev_id)) if ev_id is not None else None
+
+    def first(self):
+        events = self._snap["events"]
+        return events[0] if events else None
+
+    def link(self, ev_id):
+        return self._snap["links"].get(ev_id)
+
+    def user_text(self, ev_id):
+        return self._snap["user_text"].get(ev_id)
+
+    def admin_text(self, ev_id):
+        return self._snap["admin_text"].get(ev_id)
+
+    def approved_text(self, ev_id):
+        return self._snap["approved_text"].get(ev_id)
+
+    def register_markup(self, ev_id):
+        return self._snap["register_markup"].get(ev_id) or event_inline_register(ev_id)
+
+    def page_count(self):
+        return len(self._snap["pages"])
+
+    def list_markup(self, page=0):
+        pages = self._snap["pages"]
+        return pages[max(0, min(page, len(pages) - 1))]
+
+CATALOG = EventCatalog(EVENTS, MEETUP_LINKS)
+
+# =========================
+#     CATALOG HOT RELOAD
+# =========================
+class CatalogError(ValueError):
+    pass
+
+def validate_events(events):
+    if not isinstance(events, list):
+        raise CatalogError("events must be a list")
+    seen = set()
+    for n, e in enumerate(events):
+        if not isinstance(e, dict):
+            raise CatalogError(f"event #{n} is not an object")
+        for k in ("id", "title", "when"):
+            if not str(e.get(k, "")).strip():
+                raise CatalogError(f"event #{n} has no '{k}'")
+        ev_id = str(e["id"])
+        if ev_id in seen:
+            raise CatalogError(f"duplicate event id '{ev_id}'")
+        # callback_data is capped at 64 bytes; approve_<chat id>_<event id> is the longest
+        if len(ev_id.encode()) > 32:
+            raise CatalogError(f"event id '{ev_id}' is longer than 32 bytes")
+        cap = e.get("capacity")
+        if cap not in (None, "") and (not str(cap).isdigit()):
+            raise CatalogError(f"event '{ev_id}' has invalid capacity '{cap}'")
+        seen.add(ev_id)
+
+def _source_signature(path):
+    sig = []
+    for p in (path, path + "-wal"):
+        try:
+            st = os.stat(p)
+            sig.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            sig.append(None)
+    return tuple(sig)
+
+def load_catalog_source(path):
+    """Blocking read of EVENTS_SOURCE -> (version, events, links). Runs in a thread."""
+    if path.endswith((".db", ".sqlite", ".sqlite3")):
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            conn.row_factory = sqlite3.Row
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            events = [
+                {k: row[k] for k in row.keys() if row[k] is not None}
+                for row in conn.execute("SELECT * FROM events")
+            ]
+            try:
+                links = dict(conn.execute("SELECT event_id, link FROM meetup_links").fetchall())
+            except sqlite3.OperationalError:
+                links = {}
+        finally:
+            conn.close()
+    else:
+        with open(path, encoding="utf-8") as f:
+            raw = json.load(f)
+        if isinstance(raw, dict):
+            version, events, links = raw.get("version"), raw.get("events"), raw.get("links", {})
+        else:
+            version, events, links = None, raw, {}
+    validate_events(events)
+    if not isinstance(links, dict):
+        raise CatalogError("links must be an object")
+    return version, events, {str(k): v for k, v in links.items()}
+
+class CatalogReloader:
+    """Polls EVENTS_SOURCE (mtime/size) and swaps CATALOG atomically whenever it changed."""
+    def __init__(self, catalog, path, interval):
+        self.catalog = catalog
+        self.path = path
+        self.interval = interval
+        self.signature = None
+        self.source_version = None
+        self.last_error = None
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    async def reload(self, force=False):
+        """Returns a report dict, or None when the source did not change."""
+        async with self._lock:
+            t0 = time.perf_counter()
+            sig = _source_signature(self.path)
+            if not force and sig == self.signature:
+                return None
+            try:
+                version, events, links = await asyncio.to_thread(load_catalog_source, self.path)
+            except Exception as e:
+                self.last_error = str(e)
+                self.signature = sig  # don't re-parse a broken file until it changes again
+                print(f"Catalog reload error: {e}")
+                return {"ok": False, "error": str(e), "ms": round((time.perf_counter() - t0) * 1000, 1)}
+            prev, self.signature = self.signature, sig
+            self.last_error = None
+            # any mtime change reloads (a plain INSERT keeps user_version); an unchanged
+            # version only skips churn that left the mtimes alone (e.g. size-only WAL writes)
+            same_mtime = prev is not None and [s and s[0] for s in prev] == [s and s[0] for s in sig]
+            if not force and same_mtime and version is not None and version == self.source_version:
+                return None
+            self.source_version = version
+            diff = self.catalog.replace(events, links)
+            if reminders:
+                # reminder times follow the event times
+                try:
+                    await reminders.resync()
+                except Exception as e:
+                    print(f"Reminder resync error: {e}")
+            return {"ok": True, "events": len(self.catalog), **diff,
+                    "ms": round((time.perf_counter() - t0) * 1000, 1)}
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                report = await self.reload()
+                if report and report["ok"]:
+                    print(f"Catalog reloaded: {report}")
+            except Exception as e:
+                print(f"Catalog reload error: {e}")
+
+catalog_reloader = CatalogReloader(CATALOG, EVENTS_SOURCE, EVENTS_RELOAD_INTERVAL) if EVENTS_SOURCE else None
+
 # =========================
 #        RENDER STEPS
 # =========================
 async def render_home(update: Update, context: ContextTypes.DEFAULT_TYPE, edit=False):
     clear_flow(context)
     if edit and update.callback_query:
-        await update.callback_query.edit_message_text("یکی از گزینه‌ها رو انتخاب کن:", reply_markup=build_main_menu())
+        await update.callback_query.edit_message_text("یکی از گزینه‌ها رو انتخاب کن:", reply_markup=MAIN_MENU)
     else:
         if update.message:
             await update.message.reply_text(welcome_text, parse_mode="Markdown", reply_markup=reply_main)
-            await update.message.reply_text("یکی از گزینه‌ها رو انتخاب کن:", reply_markup=build_main_menu())
+            await update.message.reply_text("یکی از گزینه‌ها رو انتخاب کن:", reply_markup=MAIN_MENU)
         elif update.callback_query:
-            await update.callback_query.edit_message_text("یکی از گزینه‌ها رو انتخاب کن:", reply_markup=build_main_menu())
+            await update.callback_query.edit_message_text("یکی از گزینه‌ها رو انتخاب کن:", reply_markup=MAIN_MENU)
 
 async def render_event_list(update: Update):
     await update.callback_query.edit_message_text("رویدادهای پیش‌رو:", reply_markup=build_events_buttons())
 
 async def render_event_detail(update: Update, ev):
     await update.callback_query.edit_message_text(
-        event_detail_text_user(ev),
+        CATALOG.user_text(ev["id"]) or event_detail_text_user(ev),
         parse_mode="Markdown",
-        reply_markup=event_inline_register(ev["id"])
+        reply_markup=CATALOG.register_markup(ev["id"])
     )
 
-async def render_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    push_step(context, "rules")
-    if update.callback_query:
-        await update.callback_query.edit_message_text(rules_text, reply_markup=rules_inline())
-    else:
-        await update.message.reply_text(rules_text, reply_markup=rules_inline())
-
-async def render_name(update: Update, context: ContextTypes.DEFAULT_TYPE, edit=False):
-    push_step(context, "name")
-    txt = "لطفاً *نام و نام خانوادگی* رو وارد کن:"
-    if edit and update.callback_query:
-        await update.callback_query.edit_message_text(txt, parse_mode="Markdown", reply_markup=back_inline())
+# =========================
+#       FLOW ENGINE
+# =========================
+# The registration flow is a table of steps. Each step says how it is shown, which
+# user_data field it fills, how text/contact/button answers are validated, and the
+# order of FLOW defines the transitions. Adding a field (email, dietary note, ...) is
+# one more Step(...) entry; back navigation, summaries and admin cards follow.
+class Step:
+    def __init__(self, name, prompt, markup=None, parse_mode=None, field=None, label=None,
+                 validate=None, error=None, choices=None, choice_prefix=None,
+                 contact=False, ack=None, render=None):
+        self.name = name
+        self.prompt = prompt
+        self.markup = markup
+        self.parse_mode = parse_mode
+        self.field = field            # user_data key filled by this step
+        self.label = label            # (emoji, title) for user summary / admin card
+        self.validate = validate      # text -> value or None (None = invalid); no validator = no text input
+        self.error = error            # reply for invalid text
+        self.choices = choices        # callback_data -> stored value (inline buttons)
+        self.choice_prefix = choice_prefix
+        self.contact = contact        # accepts Telegram contact messages
+        self.ack = ack                # short reply after a text/contact answer (restores reply_main)
+        self.render = render          # custom renderer(update, context, step)
+
+def valid_name(text):
+    return text if 2 <= len(text) <= 60 else None
+
+def valid_any(text):
+    return text
+
+# Persian (۰-۹) and Arabic-Indic (٠-٩) digits -> ASCII; separators people type or paste
+PHONE_DIGITS = str.maketrans({**{chr(0x06F0 + i): str(i) for i in range(10)},
+                              **{chr(0x0660 + i): str(i) for i in range(10)}})
+PHONE_SEPARATORS = dict.fromkeys(map(ord, " -.()/\u00a0\u200c\u200e\u200f\u202a\u202b\u202c"))
+
+def normalize_phone(text, country=PHONE_COUNTRY_CODE):
+    """E.164 form ("+989121234567") of a typed or shared number, None if it isn't one.
+
+    "+" or "00" starts an international number, a single leading 0 a national one;
+    Telegram contacts arrive as bare international digits ("989121234567").
+    """
+    s = (text or "").translate(PHONE_DIGITS).translate(PHONE_SEPARATORS)
+    if s.startswith("+"):
+        digits = s[1:]
+    elif s.startswith("00"):
+        digits = s[2:]
+    elif s.startswith("0"):
+        digits = country + s[1:]
+    elif len(s) > 10:
+        digits = s
     else:
-        await update.effective_chat.send_message(txt, parse_mode="Markdown", reply_markup=back_inline())
-
-async def render_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    push_step(context, "phone")
-    contact_btn = ReplyKeyboardMarkup(
-        [[KeyboardButton("ارسال شماره تماس 📱", request_contact=True)]],
-        resize_keyboard=True, one_time_keyboard=True,
-    )
-    await update.effective_chat.send_message("شماره تلفنت رو وارد کن یا دکمه زیر رو بزن:", reply_markup=contact_btn)
+        digits = country + s
+    if digits.startswith(country + "0"):
+        digits = country + digits[len(country) + 1:]  # "+98 (0)912..."
+    if not (digits.isascii() and digits.isdigit()) or digits[0] == "0" or not 8 <= len(digits) <= 15:
+        return None
+    return "+" + digits
+
+def valid_phone(text):
+    return normalize_phone(text)
+
+async def render_phone_step(update: Update, context: ContextTypes.DEFAULT_TYPE, step):
+    await update.effective_chat.send_message(step.prompt, reply_markup=CONTACT_KEYBOARD)
     # برای Back از طریق inline در پیام جداگانه:
-    await update.effective_chat.send_message("یا می‌تونی به مرحله قبل برگردی:", reply_markup=back_inline())
+    await update.effective_chat.send_message("یا می‌تونی به مرحله قبل برگردی:", reply_markup=BACK_STEP_INLINE)
+
+LEVELS = {"lvl_A": "Beginner (A1–A2)", "lvl_B": "Intermediate (B1–B2)", "lvl_C": "Advanced (C1+)"}
+
+FLOW = [
+    Step("rules", rules_text, markup=RULES_INLINE),
+    Step("name", "لطفاً *نام و نام خانوادگی* رو وارد کن:", markup=BACK_STEP_INLINE, parse_mode="Markdown",
+         field="name", label=("👤", "نام"), validate=valid_name, error="لطفاً نام معتبر وارد کن (۲ تا ۶۰ کاراکتر)."),
+    Step("phone", "شماره تلفنت رو وارد کن یا دکمه زیر رو بزن:", field="phone", label=("📱", "تماس"),
+         validate=valid_phone, error="شماره معتبر نیست؛ مثلاً 09121234567 یا +989121234567 بفرست، یا دکمه ارسال شماره رو بزن.",
+         contact=True, ack="دریافت شد ✅", render=render_phone_step),
+    Step("level", "سطح زبانت چیه؟ یکی رو انتخاب کن:", markup=LEVEL_INLINE,
+         field="level", label=("🗣️", "سطح"), choices=LEVELS, choice_prefix="lvl"),
+    Step("note", "یادداشت/نیاز خاص داری؟ (اختیاری) اینجا بنویس و بفرست. اگر چیزی نداری، فقط یک خط تیره `-` بفرست.",
+         markup=BACK_STEP_INLINE, parse_mode="Markdown", field="note", label=("📝", "توضیحات"), validate=valid_any),
+]
+STEPS = {st.name: st for st in FLOW}
+NEXT_STEP = {a.name: b.name for a, b in zip(FLOW, FLOW[1:])}
+FLOW_FIELDS = [st.field for st in FLOW if st.field]
+CHOICE_STEPS = {st.choice_prefix: st for st in FLOW if st.choices}
+
+async def render_step(update: Update, context: ContextTypes.DEFAULT_TYPE, name):
+    step = STEPS[name]
+    push_step(context, name)
+    with HANDLER_SECONDS.time("step_render", name):
+        if step.render:
+            await step.render(update, context, step)
+        elif update.callback_query:
+            await update.callback_query.edit_message_text(step.prompt, parse_mode=step.parse_mode, reply_markup=step.markup)
+        else:
+            await update.effective_chat.send_message(step.prompt, parse_mode=step.parse_mode, reply_markup=step.markup)
 
-async def render_level(update: Update, context: ContextTypes.DEFAULT_TYPE, edit=False):
-    push_step(context, "level")
-    if update.callback_query and edit:
-        await update.callback_query.edit_message_text("سطح زبانت چیه؟ یکی رو انتخاب کن:", reply_markup=level_inline())
+async def advance(update: Update, context: ContextTypes.DEFAULT_TYPE, name):
+    nxt = NEXT_STEP.get(name)
+    if nxt:
+        await render_step(update, context, nxt)
     else:
-        await update.effective_chat.send_message("سطح زبانت چیه؟ یکی رو انتخاب کن:", reply_markup=level_inline())
+        await finalize_and_send(update, context)
 
-async def render_note(update: Update, context: ContextTypes.DEFAULT_TYPE, edit=False):
-    push_step(context, "note")
-    txt = "یادداشت/نیاز خاص داری؟ (اختیاری) اینجا بنویس و بفرست. اگر چیزی نداری، فقط یک خط تیره `-` بفرست."
-    if update.callback_query and edit:
-        await update.callback_query.edit_message_text(txt, parse_mode="Markdown", reply_markup=back_inline())
-    else:
-        await update.effective_chat.send_message(txt, parse_mode="Markdown", reply_markup=back_inline())
+async def accept_answer(update: Update, context: ContextTypes.DEFAULT_TYPE, step, value, ack=None):
+    with HANDLER_SECONDS.time("step_input", step.name):
+        context.user_data[step.field] = value
+        if ack:
+            # restore main keyboard after a text/contact answer
+            await update.message.reply_text(ack, reply_markup=reply_main)
+    await advance(update, context, step.name)
+
+async def on_step_text(update: Update, context: ContextTypes.DEFAULT_TYPE, text):
+    step = STEPS.get(current_step(context))
+    if step is None or step.validate is None:
+        return  # buttons-only step (rules, level, pick_event): ignore free text
+    value = step.validate(text)
+    if value is None:
+        return await update.message.reply_text(step.error or "ورودی معتبر نیست.")
+    await accept_answer(update, context, step, value, step.ack)
+
+async def on_step_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    step = STEPS.get(current_step(context))
+    if step is not None and step.contact:
+        phone = update.message.contact.phone_number
+        await accept_answer(update, context, step, normalize_phone(phone) or phone, "شماره دریافت شد ✅")
+
+async def on_step_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    step = CHOICE_STEPS[q.data.split("_", 1)[0]]
+    if current_step(context) != step.name:
+        return  # stale button from an earlier message
+    await accept_answer(update, context, step, step.choices.get(q.data, "Unknown"))
 
 async def go_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # remove current
@@ -255,221 +1045,554 @@ async def go_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return await render_event_detail(update, sel_ev)
         return await render_home(update, context, edit=True)
 
-    # Re-render previous step
-    if prev == "rules":
-        if update.callback_query:
-            await update.callback_query.edit_message_text(rules_text, reply_markup=rules_inline())
-        else:
-            await update.effective_chat.send_message(rules_text, reply_markup=rules_inline())
-    elif prev == "name":
-        await render_name(update, context, edit=True)
-    elif prev == "phone":
-        await render_phone(update, context)
-    elif prev == "level":
-        await render_level(update, context, edit=True)
-    elif prev == "note":
-        await render_note(update, context, edit=True)
-    else:
-        await render_home(update, context, edit=True)
+    if prev in STEPS:
+        # re-render previous step (render_step pushes it again)
+        pop_step(context)
+        return await render_step(update, context, prev)
+    await render_home(update, context, edit=True)
+
+def flow_summary_lines(info, bold=False):
+    lines = []
+    for st in FLOW:
+        if st.label:
+            emoji, title = st.label
+            title = f"**{title}:**" if bold else f"{title}:"
+            lines.append(f"{emoji} {title} {info.get(st.field) or '—'}")
+    return lines
 
 # =========================
 #        HANDLERS
 # =========================
+@timed_handler()
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await render_home(update, context)
 
+@timed_handler()
 async def restart_shortcut(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await render_home(update, context)
 
-async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    data = q.data
+@timed_handler()
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+    parts = (update.message.text or "").split(maxsplit=2)
+    if len(parts) < 3:
+        return await update.message.reply_text("استفاده: /broadcast <event_id> <متن پیام>")
+    ev_id, text = parts[1], parts[2]
+    if not get_event(ev_id):
+        return await update.message.reply_text("این رویداد یافت نشد.")
+    bid, total = await broadcaster.start(context.bot, ev_id, text, update.effective_chat.id)
+    await update.message.reply_text(f"📣 ارسال همگانی #{bid} برای {total} نفر شروع شد.")
+
+def duration_label(seconds):
+    minutes = seconds / 60
+    if minutes < 60:
+        return f"{minutes:.0f} دقیقه"
+    if minutes < 1440:
+        return f"{minutes / 60:.1f} ساعت"
+    return f"{minutes / 1440:.1f} روز"
+
+def stats_text(stats, ev_id=None):
+    if ev_id:
+        stats = {ev_id: stats[ev_id]} if ev_id in stats else {}
+    if not stats:
+        return "هنوز ثبت‌نامی نداریم."
+    lines = ["📊 **آمار ثبت‌نام**"]
+    for eid, st in sorted(stats.items()):
+        ev = get_event(eid)
+        counts = " | ".join(f"{REG_STATUS_LABELS.get(k, k)}: {v}" for k, v in sorted(st["status"].items()) if v)
+        lines.append(f"\n**{ev['title'] if ev else eid}** — کل: {st['registrations']}")
+        if counts:
+            lines.append(counts)
+        levels = ", ".join(f"{k}: {v}" for k, v in sorted(st["levels"].items()) if v)
+        if levels:
+            lines.append(f"سطح: {levels}")
+        if st["approval_rate"] is not None:
+            lines.append(f"نرخ تایید: {st['approval_rate'] * 100:.0f}%")
+        if st["avg_time_to_approval_seconds"] is not None:
+            lines.append(f"میانگین زمان تا تایید: {duration_label(st['avg_time_to_approval_seconds'])}")
+    return "\n".join(lines)
 
-    # guard for level (to avoid being swallowed)
-    if data.startswith("lvl_"):
-        return await handle_level(update, context)
+@timed_handler()
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+    ev_id = context.args[0] if context.args else None
+    await update.message.reply_text(stats_text(await registrations.stats(), ev_id), parse_mode='Markdown')
 
-    await q.answer()
+def approved_message(ev_id, table_no=None):
+    ev = get_event(ev_id)
+    if ev:
+        detail = CATALOG.approved_text(ev_id)
+    else:
+        detail = "🎉 ثبت‌نامت تایید شد! به‌زودی اطلاعات نهایی برات ارسال می‌شه."
+        link = CATALOG.link(ev_id)
+        if link:
+            detail += f"\n🔗 لینک گروه/هماهنگی:\n{link}"
+    if table_no:
+        detail += f"\n🪑 میز شما: {table_no}"
+    return detail
+
+# Bulk review digests: (admin chat, message id) -> {"page", "selected", "first_n"} (bounded, in
+# memory; after a restart a digest simply continues from page 1 with an empty selection)
+REVIEW_STATES = OrderedDict()
+
+def review_state(chat_id, message_id):
+    key = (chat_id, message_id)
+    state = REVIEW_STATES.pop(key, None) or {"page": 0, "selected": set(), "first_n": REVIEW_FIRST_N}
+    REVIEW_STATES[key] = state
+    while len(REVIEW_STATES) > 200:
+        REVIEW_STATES.popitem(last=False)
+    return state
+
+async def review_digest(ev_id, page, selected, first_n=REVIEW_FIRST_N):
+    # callback_data: rv_<op>_<arg>_<event id>  (event ids may contain "_", so they go last)
+    total = (await registrations.counts(ev_id)).get("pending", 0)
+    pages = max(1, -(-total // REVIEW_PAGE_SIZE))
+    page = max(0, min(page, pages - 1))
+    rows = await registrations.pending_page(ev_id, page * REVIEW_PAGE_SIZE, REVIEW_PAGE_SIZE)
+    ev = get_event(ev_id)
+    text = (f"📋 **بررسی گروهی: {ev['title'] if ev else ev_id}**\n"
+            f"در انتظار تایید: {total} | انتخاب‌شده: {len(selected)} | صفحه {page + 1}/{pages}")
+    if not total:
+        text += "\n\nثبت‌نام در انتظاری نمانده ✅"
+    buttons = []
+    for i, (chat_id, name, level) in enumerate(rows, start=page * REVIEW_PAGE_SIZE + 1):
+        mark = "☑️" if chat_id in selected else "⬜"
+        buttons.append([InlineKeyboardButton(f"{mark} {i}. {name or chat_id} — {level or '—'}",
+                                             callback_data=f"rv_t_{chat_id}_{ev_id}")])
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"rv_p_{page - 1}_{ev_id}"))
+    nav.append(InlineKeyboardButton("🔄", callback_data=f"rv_p_{page}_{ev_id}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"rv_p_{page + 1}_{ev_id}"))
+    buttons.append(nav)
+    if total:
+        if selected:
+            buttons.append([InlineKeyboardButton(f"✅ تایید انتخاب‌شده‌ها ({len(selected)})",
+                                                 callback_data=f"rv_sel_0_{ev_id}")])
+        buttons.append([InlineKeyboardButton(f"✅ تایید همه‌ی باقی‌مانده‌ها ({total})",
+                                             callback_data=f"rv_all_0_{ev_id}")])
+        buttons.append([InlineKeyboardButton(f"{first_n} نفر اول {label.split()[0]}",
+                                             callback_data=f"rv_lvl_{code[-1]}{first_n}_{ev_id}")
+                        for code, label in LEVELS.items()])
+    return text, InlineKeyboardMarkup(buttons), page
+
+async def bulk_approve(bot, ev_id, chat_ids, admin_name, report_chat_id):
+    """Approves many users at once: decisions in one transaction, confirmations through the
+    outbox (concurrency-limited dispatcher) and one progress message edited in place."""
+    won = await registrations.claim_decisions(ev_id, chat_ids, "approved", admin_name)
+    if not won:
+        return 0
+    batch = f"review:{ev_id}:{time.time_ns()}"
+    try:
+        messages = []
+        for cid in won:
+            table_no = await tables.seat_late(ev_id, cid, TABLE_SIZE)
+            messages.append((f"decision:{batch}:{cid}", cid, approved_message(ev_id, table_no), None, None))
+        await outbox.enqueue_many(messages, batch=batch)
+    except Exception:
+        # not seated or not even queued: undo decisions and seats so an admin can try again
+        await registrations.release_decisions(ev_id, won)
+        raise
+    FUNNEL.inc("approved", n=len(won))
+    if reminders:
+        ev = get_event(ev_id)
+        for cid in won:
+            await reminders.schedule(cid, ev)
+    text = bulk_progress_text(len(won), admin_name, 0, 0)
+    msg = await bot.send_message(chat_id=report_chat_id, text=text)
+    task = asyncio.create_task(track_bulk_progress(bot, msg.chat_id, msg.message_id, batch, len(won), admin_name, text))
+    BULK_PROGRESS.add(task)  # the loop only keeps weak references to tasks
+    task.add_done_callback(BULK_PROGRESS.discard)
+    return len(won)
+
+def bulk_progress_text(total, admin_name, sent, dead):
+    text = f"📤 ارسال تایید برای {total} نفر (توسط {admin_name}): {sent}/{total}"
+    if dead:
+        text += f" | ناموفق: {dead}"
+    if sent + dead >= total:
+        text += " ✅"
+    return text
+
+BULK_PROGRESS = set()  # running track_bulk_progress tasks, cancelled on shutdown
+
+async def stop_bulk_progress():
+    for task in BULK_PROGRESS:
+        task.cancel()
+    await asyncio.gather(*BULK_PROGRESS, return_exceptions=True)
+
+async def track_bulk_progress(bot, chat_id, message_id, batch, total, admin_name, last, every=2.0):
+    while True:
+        try:
+            sent, dead = await outbox.store.batch_progress(batch)
+            done = sent + dead >= total
+            text = bulk_progress_text(total, admin_name, sent, dead)
+            if text != last:
+                await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+                last = text
+            if done:
+                return
+        except Exception as e:
+            print(f"Bulk progress error: {e}")
+        await asyncio.sleep(every)
 
-    if data == "noop":
+@timed_handler()
+async def review_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
         return
+    if not context.args:
+        return await update.message.reply_text("استفاده: /review <event_id> [N]")
+    ev_id = context.args[0]
+    first_n = int(context.args[1]) if len(context.args) > 1 and context.args[1].isdigit() else REVIEW_FIRST_N
+    text, markup, _ = await review_digest(ev_id, 0, set(), first_n)
+    msg = await update.message.reply_text(text, parse_mode='Markdown', reply_markup=markup)
+    review_state(msg.chat_id, msg.message_id)["first_n"] = first_n
+
+@timed_handler()
+async def on_review(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if not is_admin(update):
+        return await q.answer()
+    _, op, arg, ev_id = q.data.split("_", 3)
+    state = review_state(q.message.chat_id, q.message.message_id)
+    selected = state["selected"]
+    if op == "t":
+        selected.symmetric_difference_update({int(arg)})
+        await q.answer()
+    elif op == "p":
+        state["page"] = int(arg)
+        await q.answer()
+    else:
+        if op == "sel":
+            chat_ids = sorted(selected)
+        elif op == "all":
+            chat_ids = await registrations.pending_ids(ev_id)
+        else:  # lvl: "<level letter><N>"
+            chat_ids = await registrations.pending_ids(ev_id, LEVELS.get("lvl_" + arg[0]), int(arg[1:]))
+        n = await bulk_approve(context.bot, ev_id, chat_ids, q.from_user.first_name, q.message.chat_id)
+        selected.clear()
+        await q.answer(f"{n} نفر تایید شد." if n else "کسی برای تایید نماند.")
+    text, markup, state["page"] = await review_digest(ev_id, state["page"], selected, state["first_n"])
+    try:
+        await q.edit_message_text(text, parse_mode='Markdown', reply_markup=markup)
+    except Exception as e:
+        print(f"Review digest update error: {e}")
 
-    if data == "back_home":
-        return await render_home(update, context, edit=True)
+@timed_handler()
+async def tables_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+    if not context.args:
+        return await update.message.reply_text("استفاده: /tables <event_id> [تعداد نفر هر میز]")
+    ev_id = context.args[0]
+    size = int(context.args[1]) if len(context.args) > 1 and context.args[1].isdigit() else TABLE_SIZE
+    people = await registrations.approved_levels(ev_id)
+    if not people:
+        return await update.message.reply_text("هنوز شرکت‌کننده‌ی تاییدشده‌ای برای این رویداد نیست.")
+    level_of = dict(people)
+    avoid = await tables.avoid_pairs(ev_id, level_of)
+    t0 = time.perf_counter()
+    # CPU work: keep the event loop free
+    seating = await asyncio.to_thread(assign_tables, people, max(2, size), avoid)
+    ms = (time.perf_counter() - t0) * 1000
+    previous = await tables.save(ev_id, seating)
+    report = table_report(seating, level_of, avoid)
+
+    # tell everyone whose table is new or changed
+    ev = get_event(ev_id)
+    title = ev["title"] if ev else ev_id
+    batch = f"tables:{ev_id}:{time.time_ns()}"
+    changed = [(cid, i) for i, t in enumerate(seating, start=1) for cid in t if previous.get(cid) != i]
+    if changed:
+        await outbox.enqueue_many([(f"table:{batch}:{cid}", cid, f"🪑 میز تو در «{title}»: شماره {i}", None, None)
+                                   for cid, i in changed], batch=batch)
+
+    lines = [f"🪑 **چیدمان میزها: {title}**",
+             f"{report['people']} نفر در {report['tables']} میز ({ms:.0f} ms) | "
+             f"هم‌میزی تکراری: {report['conflicts']} از {len(avoid)} | اطلاع‌رسانی: {len(changed)} نفر", ""]
+    for i, t in enumerate(seating, start=1):
+        mix = {}
+        for cid in t:
+            key = (level_of[cid] or "—").split()[0]
+            mix[key] = mix.get(key, 0) + 1
+        lines.append(f"میز {i}: {len(t)} نفر — " + ", ".join(f"{k} {v}" for k, v in mix.items()))
+    text = "\n".join(lines)
+    if len(text) > 3900:
+        text = text[:3900].rsplit("\n", 1)[0] + "\n…"
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+@timed_handler()
+async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+    if catalog_reloader is None:
+        return await update.message.reply_text("EVENTS_SOURCE تنظیم نشده؛ رویدادها از env خوانده می‌شوند.")
+    report = await catalog_reloader.reload(force=True)
+    if not report["ok"]:
+        return await update.message.reply_text(f"⚠️ بارگذاری رویدادها ناموفق بود (کاتالوگ قبلی حفظ شد):\n{report['error']}")
+    await update.message.reply_text(
+        f"✅ رویدادها بارگذاری شد ({report['ms']} ms)\n"
+        f"کل: {report['events']} | جدید: {report['added']} | تغییر: {report['changed']} | حذف: {report['removed']}"
+    )
 
-    if data == "back_step":
-        return await go_back(update, context)
+async def on_noop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return
 
-    if data == "faq":
-        return await q.edit_message_text(
-            faq_text, parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ بازگشت", callback_data="back_home")]])
-        )
+async def on_back_home(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await render_home(update, context, edit=True)
 
-    if data == "support":
-        return await q.edit_message_text(
-            "برای پشتیبانی به آیدی زیر پیام بده:\n@englishclub_support",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ بازگشت", callback_data="back_home")]])
-        )
+async def on_faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.edit_message_text(
+        faq_text, parse_mode='Markdown',
+        reply_markup=BACK_HOME_INLINE
+    )
 
-    if data == "list_events":
-        return await render_event_list(update)
+async def on_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.edit_message_text(
+        "برای پشتیبانی به آیدی زیر پیام بده:\n@englishclub_support",
+        reply_markup=BACK_HOME_INLINE
+    )
 
-    if data.startswith("event_"):
-        ev_id = data.split("_", 1)[1]
-        ev = get_event(ev_id)
-        if not ev:
-            return await q.answer("این رویداد یافت نشد.", show_alert=True)
-        # view-only path; if later registers from here, origin="event"
-        await render_event_detail(update, ev)
-        return
+async def on_list_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await render_event_list(update)
 
-    if data == "register" or data.startswith("register_"):
-        # registration path
-        if data.startswith("register_"):
-            context.user_data["selected_event_id"] = data.split("_", 1)[1]
-            context.user_data["origin"] = "event"
-        else:
-            context.user_data["origin"] = "menu"
-            # if no selected event, ask quick selection (compact list)
-            if not context.user_data.get("selected_event_id"):
-                await q.edit_message_text("یکی از رویدادها رو انتخاب کن:", reply_markup=build_events_buttons(compact=True))
-                # Set a light step so that back_home returns to menu
-                push_step(context, "pick_event")
-                return
-        # Continue to rules
-        await render_rules(update, context)
-        return
+async def on_events_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # same message, only the keyboard changes (works for both list and register pick)
+    tail = update.callback_query.data.rsplit("_", 1)[1]
+    page = int(tail) if tail.isdigit() else 0
+    await update.callback_query.edit_message_reply_markup(reply_markup=build_events_buttons(page=page))
 
-    if data == "accept_rules":
-        await render_name(update, context, edit=True)
-        return
+async def on_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    ev = get_event(q.data.split("_", 1)[1])
+    if not ev:
+        return await q.answer("این رویداد یافت نشد.", show_alert=True)
+    await q.answer()
+    # view-only path; if later registers from here, origin="event"
+    await render_event_detail(update, ev)
+
+async def on_register(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    data = update.callback_query.data
+    # registration path
+    if data.startswith("register_"):
+        context.user_data["selected_event_id"] = data.split("_", 1)[1]
+        context.user_data["origin"] = "event"
+    else:
+        context.user_data["origin"] = "menu"
+        # if no selected event, ask quick selection (compact list)
+        if not context.user_data.get("selected_event_id"):
+            await update.callback_query.edit_message_text(
+                "یکی از رویدادها رو انتخاب کن:", reply_markup=build_events_buttons())
+            # Set a light step so that back_home returns to menu
+            push_step(context, "pick_event")
+            return
+    # Continue to the first flow step (rules)
+    await render_step(update, context, FLOW[0].name)
+
+async def on_accept_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await advance(update, context, "rules")
+
+# callback_data -> (handler, answer the query before calling it)
+CALLBACK_ROUTES = {
+    "noop": (on_noop, True),
+    "back_home": (on_back_home, True),
+    "back_step": (go_back, True),
+    "faq": (on_faq, True),
+    "support": (on_support, True),
+    "list_events": (on_list_events, True),
+    "register": (on_register, True),
+    "accept_rules": (on_accept_rules, True),
+}
+# first "_"-separated part of callback_data -> (handler, auto answer); filled in below
+PREFIX_ROUTES = {}
+
+@timed_handler(lambda u, c: callback_key(u.callback_query.data))
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    data = q.data or ""
+    # O(1) dispatch: exact data first, then its prefix
+    route = CALLBACK_ROUTES.get(data) or PREFIX_ROUTES.get(data.split("_", 1)[0])
+    if route is None:
+        return await q.answer()
+    fn, auto_answer = route
+    if auto_answer:
+        await q.answer()
+    await fn(update, context)
+
+async def handle_decision(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Admin approve/reject; (user, event) is the idempotency key, so repeated taps by
+    # several admins (or redelivered callbacks) don't message the user twice
+    q = update.callback_query
+    try:
+        action, user_chat_id, ev_id = q.data.split("_", 2)
+        user_chat_id = int(user_chat_id)
+        ev = get_event(ev_id)
+        admin_name = q.from_user.first_name
+        status = "approved" if action == "approve" else "rejected"
 
-    # Admin approve/reject
-    if data.startswith("approve_") or data.startswith("reject_"):
-        try:
-            action, user_chat_id, ev_id = data.split("_", 2)
-            user_chat_id = int(user_chat_id)
-            ev = get_event(ev_id)
-            admin_name = q.from_user.first_name
+        won, prev_status, decided_by = await registrations.claim_decision(user_chat_id, ev_id, status, admin_name)
+        if not won:
+            label = "تایید" if prev_status == "approved" else "رد"
+            return await q.answer(f"قبلاً توسط {decided_by or 'ادمین دیگر'} {label} شده.", show_alert=True)
 
+        try:
             if action == "approve":
                 # Send full details to user (now reveal)
-                if ev:
-                    detail = (
-                        "🎉 ثبت‌نامت تایید شد!\n\n"
-                        f"📌 {ev.get('title','')}\n"
-                        f"🕒 {ev.get('when','')}\n"
-                        f"📍 {ev.get('place','—')}\n"
-                        f"🗺️ {ev.get('maps','—')}\n"
-                        f"💶 {ev.get('price','Free')}\n"
-                        f"📝 {ev.get('desc','—')}\n"
-                    )
-                else:
-                    detail = "🎉 ثبت‌نامت تایید شد! به‌زودی اطلاعات نهایی برات ارسال می‌شه."
-                link = MEETUP_LINKS.get(ev_id)
-                if link:
-                    detail += f"\n🔗 لینک گروه/هماهنگی:\n{link}"
-                await context.bot.send_message(chat_id=user_chat_id, text=detail)
+                detail = approved_message(ev_id, await tables.seat_late(ev_id, user_chat_id, TABLE_SIZE))
+            else:
+                detail = "⚠️ متاسفانه ثبت‌نامت تایید نشد."
+            # one message per tap; a redelivered callback has the same id
+            await outbox.enqueue(f"decision:{q.id}", user_chat_id, detail)
+        except Exception:
+            # not seated or not even queued: undo the decision (and seat) so an admin can try again
+            await registrations.release_decision(user_chat_id, ev_id, prev_status)
+            raise
+        if reminders:
+            if action == "approve":
+                await reminders.schedule(user_chat_id, ev)
             else:
-                await context.bot.send_message(chat_id=user_chat_id, text="⚠️ متاسفانه ثبت‌نامت تایید نشد.")
+                await reminders.cancel(user_chat_id, ev_id)
 
-            await q.answer("انجام شد.")
+        await q.answer("انجام شد.")
+        FUNNEL.inc(status)
+        await promote_waitlist(context.bot, ev_id)
+        label = "✅ تایید شد" if action == "approve" else "❌ رد شد"
+        try:
+            await q.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(
+                [[InlineKeyboardButton(f"{label} توسط {admin_name}", callback_data="noop")]]
+            ))
         except Exception as e:
-            print(f"Admin callback error: {e}")
-            await q.answer("مشکلی پیش اومد.", show_alert=True)
-        return
+            print(f"Admin card update error: {e}")
+    except Exception as e:
+        print(f"Admin callback error: {e}")
+        await q.answer("مشکلی پیش اومد.", show_alert=True)
 
+@timed_handler(lambda u, c: current_step(c) or "none")
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (update.message.text or "").strip()
-    step = current_step(context)
 
     # "شروع مجدد 🔄" via reply keyboard
     if text == "شروع مجدد 🔄":
         return await render_home(update, context)
 
-    if step == "pick_event":
-        # ignore free text during event pick (we use buttons)
-        return
-
-    if step == "name":
-        if 2 <= len(text) <= 60:
-            context.user_data["name"] = text
-            # move to phone
-            await render_phone(update, context)
-        else:
-            await update.message.reply_text("لطفاً نام معتبر وارد کن (۲ تا ۶۰ کاراکتر).")
-        return
-
-    if step == "phone":
-        # treat as manual phone entry
-        context.user_data["phone"] = text
-        # restore main keyboard after phone step
-        await update.message.reply_text("دریافت شد ✅", reply_markup=reply_main)
-        await render_level(update, context, edit=False)
-        return
-
-    if step == "note":
-        context.user_data["note"] = text
-        await finalize_and_send(update, context)
-        return
-
-    # otherwise ignore
+    await on_step_text(update, context, text)
 
+@timed_handler()
 async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if current_step(context) == "phone":
-        context.user_data["phone"] = update.message.contact.phone_number
-        # restore main keyboard after contact is received
-        await update.message.reply_text("شماره دریافت شد ✅", reply_markup=reply_main)
-        await render_level(update, context, edit=False)
+    await on_step_contact(update, context)
+
+PREFIX_ROUTES.update({
+    "events": (on_events_page, True),
+    "event": (on_event, False),
+    "register": (on_register, True),
+    # admin decisions answer the query themselves (result or "already decided" alert)
+    "approve": (handle_decision, False),
+    "reject": (handle_decision, False),
+    "rv": (on_review, False),
+    **{prefix: (on_step_choice, False) for prefix in CHOICE_STEPS},
+})
+
+def event_capacity(ev):
+    try:
+        return int(ev["capacity"]) if ev and ev.get("capacity") not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+def duplicate_lines(flags):
+    lines = []
+    if flags.get("event"):
+        lines.append(f"⚠️ **احتمال ثبت‌نام تکراری:** این شماره برای همین رویداد با حساب دیگری ثبت شده (chat `{flags['event']}`).")
+    elif flags.get("owner"):
+        lines.append(f"ℹ️ این شماره قبلاً با حساب دیگری ثبت‌نام کرده (chat `{flags['owner']}`).")
+    if flags.get("previous"):
+        lines.append(f"ℹ️ این کاربر قبلاً با شماره‌ی دیگری ثبت‌نام کرده: {flags['previous']}")
+    return lines
+
+def admin_card(user_chat_id, ev_id, ev, info, header="🔔 **ثبت‌نام جدید English Club**", flags=None):
+    approve_cb = f"approve_{user_chat_id}_{ev_id or 'NA'}"
+    reject_cb = f"reject_{user_chat_id}_{ev_id or 'NA'}"
+    buttons = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ تایید", callback_data=approve_cb),
+         InlineKeyboardButton("❌ رد", callback_data=reject_cb)]
+    ])
+    admin_txt = f"{header}\n\n" + "\n".join(flow_summary_lines(info, bold=True)) + "\n\n"
+    warnings = duplicate_lines(flags or {})
+    if warnings:
+        admin_txt += "\n".join(warnings) + "\n\n"
+    if ev:
+        admin_txt += CATALOG.admin_text(ev["id"])
+    return admin_txt, buttons
 
-async def handle_level(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    data = q.data
-    await q.answer()
-    lvl_map = {"lvl_A": "Beginner (A1–A2)", "lvl_B": "Intermediate (B1–B2)", "lvl_C": "Advanced (C1+)"}
-    context.user_data["level"] = lvl_map.get(data, "Unknown")
-    await render_note(update, context, edit=True)
+async def promote_waitlist(bot, ev_id):
+    """Fills freed seats from the waitlist: admins get a card, the user a heads-up."""
+    ev = get_event(ev_id)
 
+    def notify(promoted):
+        # runs inside the ledger transaction: a promotion and its messages commit together
+        rows = []
+        for row in promoted:
+            # each promotion happens once; the key only has to be unique
+            key = f"{ev_id}:{row['chat_id']}:{time.time_ns()}"
+            rows.append(Outbox.row(
+                f"promoted:{key}", row["chat_id"],
+                "🎟️ یک جای خالی آزاد شد و ثبت‌نامت از لیست انتظار برای تایید ادمین ارسال شد.",
+            ))
+            if GROUP_CHAT_ID:
+                flags = registrations.phones.check(ev_id, row["chat_id"], row.get("phone"))
+                txt, buttons = admin_card(row["chat_id"], ev_id, ev, row, header="🔔 **از لیست انتظار**", flags=flags)
+                rows.append(Outbox.row(f"card:{key}", GROUP_CHAT_ID, txt, buttons, 'Markdown'))
+        return rows
+
+    if await registrations.advance_waitlist(ev_id, event_capacity(ev), notify=notify):
+        outbox.notify()
+
+@timed_handler()
 async def finalize_and_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_info = context.user_data
     ev_id = user_info.get("selected_event_id")
-    if not ev_id and EVENTS:
-        ev_id = EVENTS[0]["id"]
+    if not ev_id and CATALOG.first():
+        ev_id = CATALOG.first()["id"]
         user_info["selected_event_id"] = ev_id
     ev = get_event(ev_id)
+    user_chat_id = update.effective_chat.id
+
+    # Seat reservation (atomic; full events put the user on the waitlist)
+    answers = {f: user_info.get(f) for f in FLOW_FIELDS}
+
+    def notify(status, flags):
+        # the admin card is stored with the reservation, before the user is told it was sent
+        # (waitlisted users get their card once promoted)
+        if not GROUP_CHAT_ID or status != "pending":
+            return []
+        admin_txt, buttons = admin_card(user_chat_id, ev_id, ev, user_info, flags=flags)
+        return [Outbox.row(f"card:{ev_id}:{user_chat_id}:{update.update_id}", GROUP_CHAT_ID, admin_txt,
+                           buttons, 'Markdown')]
+
+    status, duplicate, flags = await registrations.reserve(user_chat_id, ev_id or "NA", answers,
+                                                           event_capacity(ev), notify=notify)
+    if duplicate:
+        clear_flow(context)
+        return await update.effective_chat.send_message(
+            f"ℹ️ قبلاً برای این رویداد ثبت‌نام کردی (وضعیت: {REG_STATUS_LABELS.get(status, status)}).",
+            reply_markup=reply_main,
+        )
+
+    if status == "pending":
+        outbox.notify()
 
     # Summary for user (no address yet)
-    summary = (
-        "✅ درخواست ثبت‌نامت ثبت شد و برای ادمین ارسال می‌شود.\n\n"
-        f"👤 نام: {user_info.get('name','—')}\n"
-        f"📱 تماس: {user_info.get('phone','—')}\n"
-        f"🗣️ سطح: {user_info.get('level','—')}\n"
-        f"📝 توضیحات: {user_info.get('note','—')}\n"
-    )
+    if status == "waitlisted":
+        head = "⏳ ظرفیت این رویداد تکمیله؛ در لیست انتظار قرار گرفتی و اگر جایی آزاد شد خبرت می‌کنیم.\n\n"
+    else:
+        head = "✅ درخواست ثبت‌نامت ثبت شد و برای ادمین ارسال می‌شود.\n\n"
+    summary = head + "\n".join(flow_summary_lines(user_info)) + "\n"
     if ev:
         summary += f"\n📌 رویداد: {ev.get('title','')}\n🕒 زمان: {ev.get('when','')}\n(آدرس پس از تایید ارسال می‌شود.)"
     await update.effective_chat.send_message(summary, reply_markup=reply_main)
 
-    # Send to admin group with full details
-    if GROUP_CHAT_ID:
-        user_chat_id = update.effective_chat.id
-        approve_cb = f"approve_{user_chat_id}_{ev_id or 'NA'}"
-        reject_cb = f"reject_{user_chat_id}_{ev_id or 'NA'}"
-        buttons = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✅ تایید", callback_data=approve_cb),
-             InlineKeyboardButton("❌ رد", callback_data=reject_cb)]
-        ])
-        admin_txt = (
-            "🔔 **ثبت‌نام جدید English Club**\n\n"
-            f"👤 **نام:** {user_info.get('name','—')}\n"
-            f"📱 **تماس:** {user_info.get('phone','—')}\n"
-            f"🗣️ **سطح:** {user_info.get('level','—')}\n"
-            f"📝 **توضیحات:** {user_info.get('note','—')}\n\n"
-        )
-        if ev:
-            admin_txt += event_detail_text_admin(ev)
-        await context.bot.send_message(chat_id=GROUP_CHAT_ID, text=admin_txt, parse_mode='Markdown', reply_markup=buttons)
+    FUNNEL.inc("finalized_" + status)
 
     # Optionally write to Google Sheets (kept off unless creds provided)
     await maybe_write_to_sheet(user_info, ev)
@@ -480,70 +1603,2377 @@ async def finalize_and_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # =========================
 #  OPTIONAL: Google Sheets
 # =========================
-async def maybe_write_to_sheet(user_info, ev):
-    if not GSPREAD_CREDS_JSON:
-        return
-    try:
-        import gspread
-        from oauth2client.service_account import ServiceAccountCredentials
-        scope = [
-            'https://spreadsheets.google.com/feeds',
-            'https://www.googleapis.com/auth/drive'
-        ]
-        creds_dict = json.loads(GSPREAD_CREDS_JSON)
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-        client = gspread.authorize(creds)
-
+# one column per FLOW field, so a new step lands in the sheet without touching this code
+SHEET_HEADER = ["Timestamp", "Event"] + [f.title() for f in FLOW_FIELDS]
+SHEET_HEADER_RANGE = f"A1:{chr(ord('A') + len(SHEET_HEADER) - 1)}1"
+SHEET_FLUSH_SECONDS = HistogramMetric("cbot_sheet_flush_seconds", "Batched append_rows duration")
+
+class GSpreadBackend:
+    """Authorizes once and keeps the worksheet handle; runs in a worker thread."""
+    def __init__(self, creds_json, sheet_name):
+        self.creds_json = creds_json
+        self.sheet_name = sheet_name
+        self.ws = None
+
+    def _worksheet(self):
+        if self.ws is None:
+            import gspread
+            from oauth2client.service_account import ServiceAccountCredentials
+            scope = [
+                'https://spreadsheets.google.com/feeds',
+                'https://www.googleapis.com/auth/drive'
+            ]
+            creds = ServiceAccountCredentials.from_json_keyfile_dict(json.loads(self.creds_json), scope)
+            client = gspread.authorize(creds)
+            try:
+                sh = client.open(self.sheet_name)
+            except Exception:
+                sh = client.create(self.sheet_name)
+            ws = sh.sheet1
+            # header (checked once per process, not per row)
+            try:
+                if ws.get(SHEET_HEADER_RANGE) == []:
+                    ws.update(SHEET_HEADER_RANGE, [SHEET_HEADER])
+            except Exception:
+                pass
+            self.ws = ws
+        return self.ws
+
+    def append_rows(self, rows):
         try:
-            sh = client.open(SHEET_NAME)
+            self._worksheet().append_rows(rows, value_input_option="RAW")
         except Exception:
-            sh = client.create(SHEET_NAME)
-        ws = sh.sheet1
-        # header
+            self.ws = None  # re-authorize on next attempt (expired token, deleted sheet, ...)
+            raise
+
+class LocalSheetBackend:
+    """Stand-in for Google Sheets: appends rows to a local CSV file (dev/tests)."""
+    def __init__(self, path):
+        self.path = path
+
+    def append_rows(self, rows):
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, "a", newline="", encoding="utf-8") as f:
+            w = csv.writer(f)
+            if new_file:
+                w.writerow(SHEET_HEADER)
+            w.writerows(rows)
+
+class SheetSink:
+    """Buffers rows and flushes them in batches from a thread executor.
+
+    Every accepted row is first appended to a local spool file; the spool is
+    rewritten after each successful flush, so unsent rows survive a restart.
+    """
+    def __init__(self, backend, spool_path, batch_size=20, flush_interval=5.0, max_backoff=300.0):
+        self.backend = backend
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.buffer = []
+        self.failures = 0
+        self.flushed = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+        self._load_spool()
+
+    def _load_spool(self):
+        if not os.path.exists(self.spool_path):
+            return
+        with open(self.spool_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    self.buffer.append(json.loads(line))
+                except ValueError:
+                    pass  # torn last line after a crash
+
+    def _rewrite_spool(self):
+        tmp = self.spool_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for row in self.buffer:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.spool_path)
+
+    def add(self, row):
+        self.buffer.append(row)
+        with open(self.spool_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        if len(self.buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            # _run makes the last flush itself: cancelling it while an append runs in the
+            # executor and flushing again would append that batch twice
+            self._stopping = True
+            self._wakeup.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            return
         try:
-            if ws.get('A1:F1') == []:
-                ws.update('A1:F1', [["Timestamp","Event","Name","Phone","Level","Note"]])
-        except Exception:
-            pass
+            await self.flush()
+        except Exception as e:
+            print("Sheets error:", e)
+
+    async def flush(self):
+        while self.buffer:
+            batch = self.buffer[:self.batch_size]
+            with SHEET_FLUSH_SECONDS.time():
+                await asyncio.get_running_loop().run_in_executor(None, self.backend.append_rows, batch)
+            del self.buffer[:len(batch)]
+            self.flushed += len(batch)
+            self._rewrite_spool()
+
+    async def _run(self):
+        backoff = 1.0
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                backoff = 1.0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                if self._stopping:
+                    # last attempt; whatever failed stays in the spool for the next start
+                    print("Sheets error:", e)
+                    return
+                print(f"Sheets error (retry in {backoff:.0f}s):", e)
+                try:
+                    # stop() cuts the wait short
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=backoff)
+                except asyncio.TimeoutError:
+                    pass
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            if self._stopping:
+                return
+
+def claim_spool(base):
+    """First spool slot (base, base.1, ...) no live process holds; returns (path, lock file).
+
+    Slots rather than pids: uvicorn workers (WEB_CONCURRENCY) all have CBOT_WORKER_ID 0,
+    and a restarted process takes over the rows a dead one left in its slot.
+    """
+    for i in itertools.count():
+        path = base if i == 0 else f"{base}.{i}"
+        if fcntl is None:
+            return path, None  # no flock (Windows): single process only
+        lock = open(path + ".lock", "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return path, lock
+        except OSError:
+            lock.close()
+
+def build_sheet_sink():
+    if SHEET_BACKEND == "local":
+        backend = LocalSheetBackend(SHEET_LOCAL_PATH)
+    elif GSPREAD_CREDS_JSON:
+        backend = GSpreadBackend(GSPREAD_CREDS_JSON, SHEET_NAME)
+    else:
+        return None
+    # the spool is rewritten after each flush: one file per process
+    spool, lock = claim_spool(SHEET_SPOOL_PATH)
+    sink = SheetSink(backend, spool, SHEET_BATCH_SIZE, SHEET_FLUSH_INTERVAL)
+    sink.spool_lock = lock  # held open for the life of the process
+    return sink
+
+sheet_sink = build_sheet_sink()
+
+async def maybe_write_to_sheet(user_info, ev):
+    if sheet_sink is None:
+        return
+    with HANDLER_SECONDS.time("maybe_write_to_sheet", ""):
         now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-        ws.append_row([
+        sheet_sink.add([
             now,
             (ev.get('title') if ev else '—'),
-            user_info.get('name','—'),
-            user_info.get('phone','—'),
-            user_info.get('level','—'),
-            user_info.get('note','—'),
-        ])
-    except Exception as e:
-        print("Sheets error:", e)
+        ] + [user_info.get(f, '—') for f in FLOW_FIELDS])
+
+# =========================
+#   CONVERSATION STATE STORE
+# =========================
+def db_connect(path):
+    # autocommit mode; writers use explicit BEGIN IMMEDIATE so several processes can share the file
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+class LocalStore:
+    """Base for small SQLite-backed stores: one connection, calls run in a thread."""
+    SCHEMA = ()
+
+    def __init__(self, path):
+        self.conn = db_connect(path)
+        self.lock = threading.Lock()
+        for stmt in self.SCHEMA:
+            self.conn.execute(stmt)
+
+    def _locked(self, fn, *args):
+        with self.lock:
+            return fn(*args)
+
+    async def run(self, fn, *args):
+        return await asyncio.to_thread(self._locked, fn, *args)
+
+    def _tx(self, fn, *args):
+        # BEGIN IMMEDIATE takes the write lock up front, so read-modify-write is atomic across processes
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(*args)
+            self.conn.execute("COMMIT")
+            return result
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+REG_STATUS_LABELS = {
+    "pending": "در انتظار تایید",
+    "approved": "تایید شده",
+    "rejected": "رد شده",
+    "waitlisted": "لیست انتظار",
+}
+
+class PhoneIndex:
+    """Normalized phone -> registrations, in memory, for O(1) duplicate checks.
+
+    by_event[event_id][phone] is the first chat that registered the number for that event,
+    owner[phone] the first chat seen with it at all, phone_of[chat_id] the chat's last
+    number. Phones are kept as ints (E.164 digits): a few hundred thousand registrations
+    take tens of MB. Loaded from the ledger's phone_norm column (RegistrationStore).
+    """
+    def __init__(self):
+        self.by_event = {}
+        self.owner = {}
+        self.phone_of = {}
+
+    @staticmethod
+    def _key(phone):
+        return int(phone[1:]) if phone and phone.startswith("+") and phone[1:].isdigit() else None
+
+    def add(self, ev_id, chat_id, phone):
+        key = self._key(phone)
+        if key is None:
+            return
+        self.by_event.setdefault(ev_id, {}).setdefault(key, chat_id)
+        self.owner.setdefault(key, chat_id)
+        self.phone_of[chat_id] = key
+
+    def check(self, ev_id, chat_id, phone):
+        """{"event": chat, "owner": chat, "previous": phone} for whatever matches another registration."""
+        key = self._key(phone)
+        if key is None:
+            return {}
+        flags = {}
+        other = self.by_event.get(ev_id, {}).get(key)
+        if other is not None and other != chat_id:
+            flags["event"] = other
+        owner = self.owner.get(key)
+        if owner is not None and owner != chat_id:
+            flags["owner"] = owner
+        previous = self.phone_of.get(chat_id)
+        if previous is not None and previous != key:
+            flags["previous"] = f"+{previous}"
+        return flags
+
+    def __len__(self):
+        return len(self.phone_of)
+
+class RegistrationStore(LocalStore):
+    """Registration ledger: one row per (event, user) with status
+    pending -> approved | rejected, or waitlisted -> pending when a seat frees up.
+
+    Seats are held by pending + approved rows; every check-and-write runs inside
+    BEGIN IMMEDIATE, so concurrent finalizations (also from other workers) can't
+    oversell an event.
+
+    Dashboard aggregates live in reg_stats (event_id, metric) -> value and are bumped in
+    the same transaction as the ledger change, so reading them never scans registrations.
+    """
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS registrations ("
+        " chat_id INTEGER NOT NULL, event_id TEXT NOT NULL, status TEXT NOT NULL,"
+        " decided_by TEXT, decided_at REAL,"
+        " PRIMARY KEY (event_id, chat_id))",
+        "CREATE TABLE IF NOT EXISTS reg_stats ("
+        " event_id TEXT NOT NULL, metric TEXT NOT NULL, value REAL NOT NULL,"
+        " PRIMARY KEY (event_id, metric))",
+    )
+    COLUMNS = {"name": "TEXT", "phone": "TEXT", "level": "TEXT", "note": "TEXT", "created": "REAL",
+               "extra": "TEXT",  # extra: JSON of answers from flow steps without an own column
+               "phone_norm": "TEXT"}  # E.164 phone, source of the duplicate index
+    FIELDS = ("name", "phone", "level", "note")
+    INDEXES = (
+        "DROP INDEX IF EXISTS registrations_event_status",
+        "CREATE INDEX IF NOT EXISTS registrations_event_status_created ON registrations(event_id, status, created)",
+        "CREATE INDEX IF NOT EXISTS registrations_chat ON registrations(chat_id)",
+    )
+
+    EXPORT_COLUMNS = ("event_id", "chat_id", "status", "name", "phone", "level", "note", "extra",
+                      "created", "decided_by", "decided_at")
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.path = path
+        self._stats_cache = (0.0, None)
+        self.phones = PhoneIndex()
+        self._phones_rowid = 0  # ledger rows up to here are in self.phones
+        # older databases only had the decision columns
+        have = {r[1] for r in self.conn.execute("PRAGMA table_info(registrations)")}
+        for col, typ in self.COLUMNS.items():
+            if col not in have:
+                self.conn.execute(f"ALTER TABLE registrations ADD COLUMN {col} {typ}")
+        if "phone_norm" not in have:
+            self._tx(self._backfill_phones)
+        for stmt in self.INDEXES:
+            self.conn.execute(stmt)
+        # ledgers from before reg_stats existed: build the aggregates once
+        if (not self.conn.execute("SELECT 1 FROM reg_stats LIMIT 1").fetchone()
+                and self.conn.execute("SELECT 1 FROM registrations LIMIT 1").fetchone()):
+            self._tx(self._rebuild_stats)
+
+    # ---- duplicate index ----
+    def _backfill_phones(self):
+        rows = self.conn.execute("SELECT rowid, phone FROM registrations WHERE phone IS NOT NULL").fetchall()
+        self.conn.executemany("UPDATE registrations SET phone_norm=? WHERE rowid=?",
+                              [(p, rowid) for rowid, p in ((r, normalize_phone(ph)) for r, ph in rows) if p])
+
+    def _sync_phones(self):
+        # first call loads the ledger; later calls pick up rows written by other workers
+        # (a re-registration another worker made over an old row keeps its rowid and is missed)
+        rows = self.conn.execute(
+            "SELECT rowid, event_id, chat_id, phone_norm FROM registrations WHERE rowid > ? AND phone_norm IS NOT NULL",
+            (self._phones_rowid,)).fetchall()
+        for rowid, ev_id, chat_id, phone in rows:
+            self.phones.add(ev_id, chat_id, phone)
+        if rows:
+            self._phones_rowid = max(self._phones_rowid, rows[-1][0])
+        return len(rows)
+
+    async def load_phones(self):
+        """Builds the duplicate index ahead of the first registration."""
+        t0 = time.perf_counter()
+        n = await self.run(self._sync_phones)
+        print(f"Phone index: {n} registrations in {(time.perf_counter() - t0) * 1000:.0f}ms")
+
+    # ---- aggregates ----
+    def _bump(self, ev_id, deltas):
+        self.conn.executemany(
+            "INSERT INTO reg_stats(event_id, metric, value) VALUES (?,?,?) "
+            "ON CONFLICT(event_id, metric) DO UPDATE SET value=value+excluded.value",
+            [(ev_id, k, v) for k, v in deltas.items() if v],
+        )
+        self._stats_cache = (0.0, None)  # this process wrote: next read sees it (other workers: after TTL)
+
+    @staticmethod
+    def _move(deltas, old, new):
+        # row leaves `old` and enters `new`, e.g. ("status:pending", "status:approved")
+        if old:
+            deltas[old] = deltas.get(old, 0) - 1
+        if new:
+            deltas[new] = deltas.get(new, 0) + 1
+        return deltas
+
+    def _rebuild_stats(self):
+        self.conn.execute("DELETE FROM reg_stats")
+        rows = self.conn.execute(
+            "SELECT event_id, 'status:' || status, COUNT(*) FROM registrations GROUP BY event_id, status "
+            "UNION ALL SELECT event_id, 'level:' || level, COUNT(*) FROM registrations "
+            " WHERE level IS NOT NULL GROUP BY event_id, level "
+            "UNION ALL SELECT event_id, 'registrations', COUNT(*) FROM registrations "
+            " WHERE created IS NOT NULL GROUP BY event_id "
+            "UNION ALL SELECT event_id, 'approve_seconds', SUM(decided_at - created) FROM registrations "
+            " WHERE status='approved' AND created IS NOT NULL GROUP BY event_id "
+            "UNION ALL SELECT event_id, 'approve_count', COUNT(*) FROM registrations "
+            " WHERE status='approved' AND created IS NOT NULL GROUP BY event_id"
+        ).fetchall()
+        self.conn.executemany("INSERT INTO reg_stats(event_id, metric, value) VALUES (?,?,?)", rows)
+
+    def _stats(self):
+        out = {}
+        for ev_id, metric, value in self.conn.execute("SELECT event_id, metric, value FROM reg_stats"):
+            ev = out.setdefault(ev_id, {"registrations": 0, "status": {}, "levels": {},
+                                        "approve_seconds": 0.0, "approve_count": 0})
+            kind, _, name = metric.partition(":")
+            if name and not value:
+                continue
+            if kind == "status":
+                ev["status"][name] = int(value)
+            elif kind == "level":
+                ev["levels"][name] = int(value)
+            else:
+                ev[kind] = value
+        for ev in out.values():
+            st = ev["status"]
+            decided = st.get("approved", 0) + st.get("rejected", 0)
+            ev["registrations"] = int(ev["registrations"])
+            ev["approval_rate"] = round(st.get("approved", 0) / decided, 4) if decided else None
+            count = int(ev.pop("approve_count"))
+            seconds = ev.pop("approve_seconds")
+            ev["avg_time_to_approval_seconds"] = round(seconds / count, 1) if count else None
+        return out
+
+    async def stats(self):
+        """Per-event aggregates: registrations, status and level counts, approval rate,
+        average time to approval. Served from a short-lived snapshot under load."""
+        ts, snapshot = self._stats_cache
+        if snapshot is None or time.monotonic() - ts > STATS_CACHE_TTL:
+            snapshot = await self.run(self._stats)
+            self._stats_cache = (time.monotonic(), snapshot)
+        return snapshot
+
+    def iter_csv(self, ev_id=None, batch=500):
+        """CSV of the ledger in chunks (own connection; meant for a streaming response)."""
+        conn = db_connect(self.path)
+        try:
+            sql = f"SELECT {', '.join(self.EXPORT_COLUMNS)} FROM registrations"
+            cur = conn.execute(sql + " WHERE event_id=? ORDER BY created" if ev_id else sql + " ORDER BY event_id, created",
+                               (ev_id,) if ev_id else ())
+            buf = io.StringIO()
+            w = csv.writer(buf)
+            w.writerow(self.EXPORT_COLUMNS)
+            while True:
+                rows = cur.fetchmany(batch)
+                if not rows:
+                    break
+                w.writerows(rows)
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+            if buf.tell():
+                yield buf.getvalue()
+        finally:
+            conn.close()
+
+    def _held_seats(self, ev_id):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM registrations WHERE event_id=? AND status IN ('pending','approved')", (ev_id,)
+        ).fetchone()[0]
+
+    def _reserve(self, chat_id, ev_id, info, capacity):
+        row = self.conn.execute(
+            "SELECT status, level, created FROM registrations WHERE event_id=? AND chat_id=?", (ev_id, chat_id)
+        ).fetchone()
+        if row and row[0] != "rejected":
+            return row[0], True, {}
+        phone = normalize_phone(info.get("phone"))
+        self._sync_phones()
+        flags = self.phones.check(ev_id, chat_id, phone)
+        status = "pending" if capacity is None or self._held_seats(ev_id) < capacity else "waitlisted"
+        # "registrations" counts users who submitted the form (re-registering after a rejection is not a new one)
+        deltas = {"registrations": 0 if row and row[2] else 1}
+        self._move(deltas, row and "status:" + row[0], "status:" + status)
+        self._move(deltas, row and row[1] and "level:" + row[1], info.get("level") and "level:" + info["level"])
+        self._bump(ev_id, deltas)
+        extra = {k: v for k, v in info.items() if k not in self.FIELDS}
+        self.conn.execute(
+            "INSERT INTO registrations(chat_id, event_id, status, name, phone, level, note, extra, created, phone_norm) "
+            "VALUES (?,?,?,?,?,?,?,?,?,?) ON CONFLICT(event_id, chat_id) DO UPDATE SET "
+            "status=excluded.status, name=excluded.name, phone=excluded.phone, level=excluded.level, "
+            "note=excluded.note, extra=excluded.extra, created=excluded.created, phone_norm=excluded.phone_norm, "
+            "decided_by=NULL, decided_at=NULL",
+            (chat_id, ev_id, status, info.get("name"), info.get("phone"), info.get("level"),
+             info.get("note"), json.dumps(extra, ensure_ascii=False) if extra else None, time.time(), phone),
+        )
+        self.phones.add(ev_id, chat_id, phone)
+        return status, False, flags
+
+    def _reserve_notify(self, chat_id, ev_id, info, capacity, notify):
+        status, duplicate, flags = self._reserve(chat_id, ev_id, info, capacity)
+        if notify and not duplicate:
+            OutboxStore.insert(self.conn, notify(status, flags))
+        return status, duplicate, flags
+
+    async def reserve(self, chat_id, ev_id, info, capacity=None, notify=None):
+        """Creates the registration; returns (status, duplicate, flags).
+
+        status is "pending", or "waitlisted" when the event is full; duplicate=True
+        means the user already has an open registration for this event (nothing written).
+        flags: PhoneIndex.check() of the phone against other registrations (for the admin card).
+        notify(status, flags) -> outbox rows (Outbox.row) stored in the same transaction.
+        """
+        return await self.run(self._tx, self._reserve_notify, chat_id, ev_id, info, capacity, notify)
+
+    def _advance_waitlist(self, ev_id, capacity):
+        if capacity is None:
+            free = -1  # no limit: everyone waiting can move up
+        else:
+            free = capacity - self._held_seats(ev_id)
+            if free <= 0:
+                return []
+        rows = self.conn.execute(
+            "SELECT chat_id, name, phone, level, note, extra FROM registrations "
+            "WHERE event_id=? AND status='waitlisted' ORDER BY created LIMIT ?", (ev_id, free)
+        ).fetchall()
+        self.conn.executemany(
+            "UPDATE registrations SET status='pending' WHERE event_id=? AND chat_id=?",
+            [(ev_id, r[0]) for r in rows],
+        )
+        self._bump(ev_id, {"status:waitlisted": -len(rows), "status:pending": len(rows)})
+        return [
+            {**(json.loads(r[5]) if r[5] else {}),
+             "chat_id": r[0], "name": r[1], "phone": r[2], "level": r[3], "note": r[4]}
+            for r in rows
+        ]
+
+    def _advance_waitlist_notify(self, ev_id, capacity, notify):
+        promoted = self._advance_waitlist(ev_id, capacity)
+        if notify and promoted:
+            OutboxStore.insert(self.conn, notify(promoted))
+        return promoted
+
+    async def advance_waitlist(self, ev_id, capacity, notify=None):
+        """Moves the oldest waitlisted users to pending while seats are free; returns them.
+        notify(promoted) -> outbox rows (Outbox.row) stored in the same transaction."""
+        return await self.run(self._tx, self._advance_waitlist_notify, ev_id, capacity, notify)
+
+    async def counts(self, ev_id):
+        return await self.run(lambda: dict(self.conn.execute(
+            "SELECT status, COUNT(*) FROM registrations WHERE event_id=? GROUP BY status", (ev_id,))))
+
+    async def get(self, chat_id, ev_id):
+        def _get():
+            self.conn.row_factory = sqlite3.Row
+            try:
+                row = self.conn.execute(
+                    "SELECT * FROM registrations WHERE event_id=? AND chat_id=?", (ev_id, chat_id)).fetchone()
+            finally:
+                self.conn.row_factory = None
+            return dict(row) if row else None
+        return await self.run(_get)
+
+    def _record_decision(self, chat_id, ev_id, status, admin_name, prev_status=None, created=None):
+        now = time.time()
+        self.conn.execute(
+            "INSERT INTO registrations(chat_id, event_id, status, decided_by, decided_at) VALUES (?,?,?,?,?) "
+            "ON CONFLICT(event_id, chat_id) DO UPDATE SET status=excluded.status, "
+            "decided_by=excluded.decided_by, decided_at=excluded.decided_at",
+            (chat_id, ev_id, status, admin_name, now),
+        )
+        deltas = self._move({}, prev_status and "status:" + prev_status, "status:" + status)
+        if status == "approved" and created:
+            deltas.update({"approve_seconds": now - created, "approve_count": 1})
+        self._bump(ev_id, deltas)
+
+    def _claim_decision(self, chat_id, ev_id, status, admin_name):
+        row = self.conn.execute(
+            "SELECT status, decided_by, created FROM registrations WHERE event_id=? AND chat_id=?", (ev_id, chat_id)
+        ).fetchone()
+        if row and row[0] in ("approved", "rejected"):
+            return False, row[0], row[1]
+        self._record_decision(chat_id, ev_id, status, admin_name, row and row[0], row and row[2])
+        return True, (row[0] if row else None), admin_name
+
+    async def claim_decision(self, chat_id, ev_id, status, admin_name):
+        """Atomically records the first decision for (user, event).
+
+        Returns (won, previous_status, decided_by); when won is False nothing changed and
+        decided_by names the admin who decided first.
+        """
+        return await self.run(self._tx, self._claim_decision, chat_id, ev_id, status, admin_name)
+
+    def _claim_decisions(self, ev_id, chat_ids, status, admin_name):
+        won = {}
+        for cid in chat_ids:
+            ok, prev_status, _ = self._claim_decision(cid, ev_id, status, admin_name)
+            if ok:
+                won[cid] = prev_status
+        return won
+
+    async def claim_decisions(self, ev_id, chat_ids, status, admin_name):
+        """claim_decision for many users in one transaction.
+
+        Returns {chat_id: previous_status} for the users this call decided (for release_decisions).
+        """
+        return await self.run(self._tx, self._claim_decisions, ev_id, chat_ids, status, admin_name)
+
+    async def approved_levels(self, ev_id):
+        """[(chat_id, level)] of approved registrations."""
+        return await self.run(lambda: self.conn.execute(
+            "SELECT chat_id, level FROM registrations WHERE event_id=? AND status='approved'", (ev_id,)).fetchall())
+
+    async def pending_page(self, ev_id, offset, limit):
+        """(chat_id, name, level) of pending registrations, oldest first."""
+        return await self.run(lambda: self.conn.execute(
+            "SELECT chat_id, name, level FROM registrations WHERE event_id=? AND status='pending' "
+            "ORDER BY created LIMIT ? OFFSET ?", (ev_id, limit, offset)).fetchall())
+
+    async def pending_ids(self, ev_id, level=None, limit=-1):
+        sql = "SELECT chat_id FROM registrations WHERE event_id=? AND status='pending'"
+        args = (ev_id,)
+        if level is not None:
+            sql, args = sql + " AND level=?", args + (level,)
+        return await self.run(lambda: [r[0] for r in self.conn.execute(
+            sql + " ORDER BY created LIMIT ?", args + (limit,))])
+
+    def _release_decision(self, chat_id, ev_id, prev_status):
+        row = self.conn.execute(
+            "SELECT status, created, decided_at FROM registrations WHERE event_id=? AND chat_id=?", (ev_id, chat_id)
+        ).fetchone()
+        if not row:
+            return
+        deltas = self._move({}, "status:" + row[0], prev_status and "status:" + prev_status)
+        if row[0] == "approved" and row[1] and row[2]:
+            deltas.update({"approve_seconds": row[1] - row[2], "approve_count": -1})
+        self._bump(ev_id, deltas)
+        if row[0] == "approved":
+            # an undecided user has no seat; one taken for this approval goes with it
+            TableStore.unseat(self.conn, ev_id, chat_id)
+        if prev_status is None:
+            self.conn.execute("DELETE FROM registrations WHERE event_id=? AND chat_id=?", (ev_id, chat_id))
+        else:
+            self.conn.execute(
+                "UPDATE registrations SET status=?, decided_by=NULL, decided_at=NULL "
+                "WHERE event_id=? AND chat_id=?", (prev_status, ev_id, chat_id))
+
+    async def release_decision(self, chat_id, ev_id, prev_status):
+        """Undoes claim_decision (and the table seat an approval took)."""
+        await self.run(self._tx, self._release_decision, chat_id, ev_id, prev_status)
+
+    def _release_decisions(self, ev_id, decided):
+        for cid, prev_status in decided.items():
+            self._release_decision(cid, ev_id, prev_status)
+
+    async def release_decisions(self, ev_id, decided):
+        """Undoes claim_decisions: decided is its {chat_id: previous_status}."""
+        await self.run(self._tx, self._release_decisions, ev_id, decided)
+
+    def _chat_ids(self, ev_id, status):
+        return [r[0] for r in self.conn.execute(
+            "SELECT chat_id FROM registrations WHERE event_id=? AND status=?", (ev_id, status))]
+
+    async def approved_chat_ids(self, ev_id):
+        return await self.run(self._chat_ids, ev_id, "approved")
+
+STATE_CONFLICTS = CounterMetric("cbot_state_conflicts_total", "user_data writes lost to a newer version from another process")
+
+class SQLitePersistence(BasePersistence):
+    """user_data (nav stack + registration fields) in SQLite.
+
+    - only users whose data actually changed are written, in one transaction per batch
+    - every row carries a version; before each update PTB calls refresh_user_data and we
+      reload the user if another worker process wrote a newer version
+    - writes are compare-and-set against the version this process last saw: if another
+      process got there first, its state wins and ours is reloaded on the next update
+    - write_through() is awaited after every update, so the next process to see the
+      user already reads the new state (update_interval is only a fallback)
+    """
+    def __init__(self, path, update_interval=1.0):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.conn = db_connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_state ("
+            " user_id INTEGER PRIMARY KEY, data TEXT NOT NULL,"
+            " version INTEGER NOT NULL, updated REAL NOT NULL)"
+        )
+        self.lock = threading.Lock()
+        self.versions = {}   # user_id -> version last seen/written by this process
+        self.written = {}    # user_id -> last written JSON (skip unchanged users)
+        self.dirty = {}      # user_id -> JSON to write, or None to delete
+        self._flush_task = None
+
+    async def get_user_data(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT user_id, data, version FROM user_state").fetchall()
+        result = {}
+        for uid, data, version in rows:
+            result[uid] = json.loads(data)
+            self.versions[uid] = version
+            self.written[uid] = data
+        return result
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self.dirty:
+            return  # our own pending write is the newest state
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data, version FROM user_state WHERE user_id=?", (user_id,)
+            ).fetchone()
+        if row is None:
+            if self.versions.pop(user_id, None) is not None:
+                user_data.clear()  # dropped by another worker
+                self.written.pop(user_id, None)
+            return
+        data, version = row
+        if self.versions.get(user_id) != version:
+            user_data.clear()
+            user_data.update(json.loads(data))
+            self.versions[user_id] = version
+            self.written[user_id] = data
+
+    async def update_user_data(self, user_id, data):
+        blob = json.dumps(data, ensure_ascii=False, sort_keys=True)
+        if self.written.get(user_id) == blob:
+            return
+        self.dirty[user_id] = blob
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self.dirty[user_id] = None
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        # PTB hands over changed users one by one; coalesce them into one transaction
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self.flush())
+
+    def _write(self, batch, seen):
+        """Returns {user_id: new version, or None if another process changed the row first}."""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                versions = {}
+                for uid, blob in batch.items():
+                    version = seen.get(uid)
+                    if blob is None:
+                        # dropping a row someone else has rewritten would lose their state
+                        self.conn.execute("DELETE FROM user_state WHERE user_id=? AND version=?", (uid, version))
+                        versions[uid] = None
+                    elif version is None:
+                        cur = self.conn.execute(
+                            "INSERT INTO user_state(user_id, data, version, updated) VALUES (?,?,1,?) "
+                            "ON CONFLICT(user_id) DO NOTHING", (uid, blob, now))
+                        versions[uid] = 1 if cur.rowcount else None
+                    else:
+                        cur = self.conn.execute(
+                            "UPDATE user_state SET data=?, version=version+1, updated=? "
+                            "WHERE user_id=? AND version=?", (blob, now, uid, version))
+                        versions[uid] = version + 1 if cur.rowcount else None
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return versions
+
+    async def flush(self):
+        await asyncio.sleep(0)  # let the current persistence run hand over all changed users
+        # users handed over while a batch is being written go out in the next round
+        while self.dirty:
+            batch, self.dirty = self.dirty, {}
+            try:
+                versions = await asyncio.to_thread(self._write, batch, dict(self.versions))
+            except Exception as e:
+                print("State store error:", e)
+                for uid, blob in batch.items():
+                    self.dirty.setdefault(uid, blob)  # retried with the next batch
+                return
+            for uid, blob in batch.items():
+                if blob is not None and versions[uid] is not None:
+                    self.versions[uid] = versions[uid]
+                    self.written[uid] = blob
+                    continue
+                if blob is not None:
+                    STATE_CONFLICTS.inc()
+                # dropped, or lost the compare-and-set: refresh_user_data reloads whatever is stored
+                self.versions.pop(uid, None)
+                self.written.pop(uid, None)
+
+    async def write_through(self, application):
+        """Hands this update's changes to the store and waits until they are committed."""
+        await application.update_persistence()
+        if self._flush_task:
+            await asyncio.shield(self._flush_task)
+
+    # only user_data is persisted
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+# =========================
+#   OUTGOING SEND SCHEDULER
+# =========================
+# Priorities for `rate_limit_args={"priority": ...}` on bot calls (lower = sooner)
+PRIORITY_INTERACTIVE = 0   # direct replies to the user who is tapping right now (default)
+PRIORITY_ADMIN = 1         # admin-group cards (default for GROUP_CHAT_ID)
+PRIORITY_BULK = 2          # reminders / broadcasts
+
+THROTTLED_PREFIXES = ("send", "edit", "copy", "forward")
+# True while a handler runs for an incoming update: its replies skip per-chat pacing
+# (a reply waiting out 1 msg/s would hold one of the few update workers)
+IN_UPDATE = contextvars.ContextVar("cbot_in_update", default=False)
+
+class SendScheduler(BaseRateLimiter):
+    """Throttles message-type Bot API calls with a global and a per-chat budget.
+
+    Each chat has a FIFO of pending calls and at most one call in flight, so order per
+    chat is kept. Among chats whose budget allows a send, the head with the best
+    (priority, arrival) goes next. A 429 pauses sending for `retry_after` and re-queues
+    the call at the front of its chat. Queued plain texts to the same chat can be merged
+    into one sendMessage.
+    """
+    def __init__(self, global_rate, private_rate, group_rate, admin_chat_id=0, coalesce=True, max_retries=3):
+        self.global_rate = global_rate
+        self.group_rate = group_rate
+        self.share = 1.0
+        self.global_interval = 1.0 / global_rate
+        self.private_interval = 1.0 / private_rate
+        self.group_interval = 1.0 / group_rate
+        self.admin_chat_id = admin_chat_id
+        self.coalesce = coalesce
+        self.max_retries = max_retries
+        self.pending = {}        # chat_id -> deque of items
+        self.in_flight = set()   # chat ids with a call on the wire
+        self.chat_next = {}      # chat_id -> monotonic time of next allowed send
+        self.global_next = 0.0
+        self.paused_until = 0.0
+        self.seq = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.retry_after_count = 0
+        self.waits = deque(maxlen=1000)  # seconds from enqueue to dispatch
+        self._wakeup = None
+        self._task = None
+        self._budget_task = None
+
+    async def initialize(self):
+        # PTB initializes the bot twice (application + updater): a second call must not
+        # start another dispatch loop (two loops would each spend the whole budget)
+        if self._task:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._dispatch_loop())
+
+    async def shutdown(self):
+        for task in (self._task, self._budget_task):
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._task = self._budget_task = None
+
+    def set_share(self, share):
+        """Fraction of the bot-wide budget this process may use (multi-process mode).
+
+        Private chats belong to one process, so only the global and group (admin group)
+        rates are split; a pause after a 429 is shared as well.
+        """
+        self.share = share
+        self.global_interval = 1.0 / (self.global_rate * share)
+        self.group_interval = 1.0 / (self.group_rate * share)
+
+    def start_budget(self, store, worker_id, interval):
+        self._budget_task = asyncio.create_task(self._budget_loop(store, worker_id, interval))
+
+    async def _budget_loop(self, store, worker_id, interval):
+        while True:
+            try:
+                # backlog + 1: idle processes keep a small share, busy ones get the rest
+                demand = sum(len(q) for q in self.pending.values()) + len(self.in_flight) + 1
+                paused_wall = time.time() + max(0.0, self.paused_until - time.monotonic())
+                share, paused_until = await store.lease(worker_id, demand, paused_wall, stale=3 * interval)
+                self.set_share(share)
+                if paused_until > time.time():
+                    # another process got a 429: the flood limit is per bot, so wait as well
+                    self.paused_until = max(self.paused_until, time.monotonic() + paused_until - time.time())
+                self._wakeup.set()
+            except Exception as e:
+                print(f"Send budget lease error: {e}")
+            await asyncio.sleep(interval)
+
+    def _priority(self, data, rate_limit_args):
+        if isinstance(rate_limit_args, dict) and "priority" in rate_limit_args:
+            return int(rate_limit_args["priority"])
+        if isinstance(rate_limit_args, int):
+            return rate_limit_args
+        if self.admin_chat_id and data.get("chat_id") == self.admin_chat_id:
+            return PRIORITY_ADMIN
+        return PRIORITY_INTERACTIVE
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        # a no-op edit is answered by the render cache: don't spend a send slot on it
+        # (only with nothing queued for the chat, or an earlier edit could land after it)
+        noop = endpoint in RenderCache.EDITS and chat_id not in self.pending and chat_id not in self.in_flight \
+            and RENDER_CACHE.lookup(endpoint, data) is not None
+        if chat_id is None or not endpoint.startswith(THROTTLED_PREFIXES) or self._task is None or noop:
+            return await self._call_direct(callback, args, kwargs)
+        # replies made while handling an update: global budget and per-chat order only;
+        # explicit priorities (broadcasts, reminders) are always paced
+        interactive = IN_UPDATE.get() and rate_limit_args is None
+        self.seq += 1
+        item = {
+            "priority": PRIORITY_INTERACTIVE if interactive else self._priority(data, rate_limit_args),
+            "paced": not interactive,
+            "seq": self.seq,
+            "enqueued": time.monotonic(),
+            "callback": callback,
+            "endpoint": endpoint,
+            "data": data,
+            "kwargs": kwargs,
+            "future": asyncio.get_running_loop().create_future(),
+            "retries": 0,
+        }
+        q = self.pending.setdefault(chat_id, deque())
+        if interactive:
+            # ahead of paced sends already queued for the chat (e.g. admin cards waiting out
+            # the group limit), behind earlier replies so the user still sees them in order
+            i = next((n for n, it in enumerate(q) if it["paced"]), len(q))
+            q.insert(i, item)
+        else:
+            q.append(item)
+        self._wakeup.set()
+        return await item["future"]
+
+    async def _call_direct(self, callback, args, kwargs):
+        # answerCallbackQuery, getMe, setWebhook, ... are not throttled, but wait out a
+        # 429 pause and retry on RetryAfter instead of raising it into the handler
+        for attempt in range(self.max_retries + 1):
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self._note_retry_after(e)
+                if attempt == self.max_retries:
+                    raise
+
+    def _note_retry_after(self, e):
+        self.retry_after_count += 1
+        retry_after = e.retry_after if isinstance(e.retry_after, (int, float)) else e.retry_after.total_seconds()
+        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def _chat_interval(self, chat_id):
+        is_group = isinstance(chat_id, str) or chat_id < 0
+        return self.group_interval if is_group else self.private_interval
+
+    async def _dispatch_loop(self):
+        while True:
+            now = time.monotonic()
+            best, best_key, next_ready = None, None, None
+            if now >= self.paused_until:
+                for chat_id, q in self.pending.items():
+                    if chat_id in self.in_flight:
+                        continue
+                    head = q[0]
+                    ready_at = self.chat_next.get(chat_id, 0.0) if head["paced"] else 0.0
+                    if ready_at > now:
+                        next_ready = ready_at if next_ready is None else min(next_ready, ready_at)
+                        continue
+                    key = (head["priority"], head["seq"])
+                    if best_key is None or key < best_key:
+                        best, best_key = chat_id, key
+            else:
+                next_ready = self.paused_until
+            if best is not None and now < self.global_next:
+                next_ready = self.global_next
+                best = None
+            if best is None:
+                self._wakeup.clear()
+                timeout = None if next_ready is None else max(0.0, next_ready - now)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            items = self._take(best)
+            self.global_next = max(now, self.global_next) + self.global_interval
+            self.chat_next[best] = now + self._chat_interval(best)
+            self.in_flight.add(best)
+            asyncio.create_task(self._send(best, items))
+
+    def _take(self, chat_id):
+        q = self.pending[chat_id]
+        items = [q.popleft()]
+        first = items[0]
+        if self.coalesce and first["priority"] > PRIORITY_INTERACTIVE and self._mergeable(first):
+            size = len(first["data"]["text"])
+            # merge following plain texts with the same formatting; only the last may carry a keyboard
+            while q and self._mergeable(q[0], allow_markup=True) \
+                    and q[0]["data"].get("parse_mode") == first["data"].get("parse_mode") \
+                    and q[0]["priority"] == first["priority"] \
+                    and size + 2 + len(q[0]["data"]["text"]) <= 4096:
+                size += 2 + len(q[0]["data"]["text"])
+                items.append(q.popleft())
+                if items[-1]["data"].get("reply_markup") is not None:
+                    break
+        if not q:
+            del self.pending[chat_id]
+        return items
+
+    @staticmethod
+    def _mergeable(item, allow_markup=False):
+        data = item["data"]
+        return item["endpoint"] == "sendMessage" and isinstance(data.get("text"), str) \
+            and (allow_markup or data.get("reply_markup") is None) \
+            and not data.get("entities") and not data.get("reply_to_message_id")
+
+    async def _send(self, chat_id, items):
+        now = time.monotonic()
+        for it in items:
+            if not it["retries"]:
+                self.waits.append(now - it["enqueued"])
+        last = items[-1]
+        data = last["data"]
+        if len(items) > 1:
+            data = dict(data, text="\n\n".join(it["data"]["text"] for it in items))
+        try:
+            result = await last["callback"](last["endpoint"], data, **last["kwargs"])
+        except RetryAfter as e:
+            self._note_retry_after(e)
+            if last["retries"] >= self.max_retries:
+                for it in items:
+                    if not it["future"].done():
+                        it["future"].set_exception(e)
+            else:
+                for it in items:
+                    it["retries"] += 1
+                self.pending.setdefault(chat_id, deque()).extendleft(reversed(items))
+        except Exception as e:
+            for it in items:
+                if not it["future"].done():
+                    it["future"].set_exception(e)
+        else:
+            self.sent += 1
+            self.coalesced += len(items) - 1
+            for it in items:
+                if not it["future"].done():
+                    it["future"].set_result(result)
+        finally:
+            self.in_flight.discard(chat_id)
+            self._wakeup.set()
+
+    def stats(self):
+        waits = sorted(self.waits)
+
+        def pct(p):
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))] * 1000, 1) if waits else 0.0
+
+        return {
+            "queued": sum(len(q) for q in self.pending.values()),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "retry_after": self.retry_after_count,
+            "share": round(self.share, 3),
+            "wait_ms": {"p50": pct(0.50), "p95": pct(0.95), "p99": pct(0.99)},
+        }
+
+class SendBudgetStore(LocalStore):
+    """Splits the bot-wide send budget between worker processes, in proportion to backlog.
+
+    Every process upserts (demand, paused_until, heartbeat) about once a second and reads
+    back its share of all live processes' demand.
+    """
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS send_budget ("
+        " worker INTEGER PRIMARY KEY, demand REAL NOT NULL, paused_until REAL NOT NULL, heartbeat REAL NOT NULL)",
+    )
+
+    def _lease(self, worker_id, demand, paused_until, stale):
+        now = time.time()
+        self.conn.execute(
+            "INSERT INTO send_budget(worker, demand, paused_until, heartbeat) VALUES (?,?,?,?) "
+            "ON CONFLICT(worker) DO UPDATE SET demand=excluded.demand, paused_until=excluded.paused_until, "
+            "heartbeat=excluded.heartbeat",
+            (worker_id, demand, paused_until, now),
+        )
+        total, paused = self.conn.execute(
+            "SELECT SUM(demand), MAX(paused_until) FROM send_budget WHERE heartbeat > ?", (now - stale,)
+        ).fetchone()
+        return (demand / total if total else 1.0), (paused or 0.0)
+
+    async def lease(self, worker_id, demand, paused_until, stale):
+        """Returns (share of the budget, latest pause deadline of any live process, wall clock)."""
+        return await self.run(self._tx, self._lease, worker_id, demand, paused_until, stale)
+
+# =========================
+#        BROADCASTS
+# =========================
+class BroadcastStore(LocalStore):
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS broadcasts ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT, event_id TEXT NOT NULL, text TEXT NOT NULL,"
+        " report_chat_id INTEGER, created REAL NOT NULL, finished REAL)",
+        "CREATE TABLE IF NOT EXISTS broadcast_targets ("
+        " broadcast_id INTEGER NOT NULL, chat_id INTEGER NOT NULL,"
+        " status TEXT NOT NULL DEFAULT 'pending', error TEXT,"
+        " PRIMARY KEY (broadcast_id, chat_id))",
+    )
+
+    def __init__(self, path):
+        super().__init__(path)
+        # owner/claimed: lease of the process sending it (several processes share the table)
+        have = {r[1] for r in self.conn.execute("PRAGMA table_info(broadcasts)")}
+        for col, typ in (("owner", "TEXT"), ("claimed", "REAL")):
+            if col not in have:
+                self.conn.execute(f"ALTER TABLE broadcasts ADD COLUMN {col} {typ}")
+
+    def _create(self, ev_id, text, report_chat_id, chat_ids, owner):
+        now = time.time()
+        cur = self.conn.execute(
+            "INSERT INTO broadcasts(event_id, text, report_chat_id, created, owner, claimed) VALUES (?,?,?,?,?,?)",
+            (ev_id, text, report_chat_id, now, owner, now),
+        )
+        bid = cur.lastrowid
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO broadcast_targets(broadcast_id, chat_id) VALUES (?,?)",
+            [(bid, c) for c in chat_ids],
+        )
+        return bid
+
+    async def create(self, ev_id, text, report_chat_id, chat_ids, owner):
+        """New broadcast, already claimed by `owner`."""
+        return await self.run(self._tx, self._create, ev_id, text, report_chat_id, chat_ids, owner)
+
+    def _claim(self, bid, owner, lease):
+        now = time.time()
+        return self.conn.execute(
+            "UPDATE broadcasts SET owner=?, claimed=? WHERE id=? AND finished IS NULL "
+            "AND (claimed IS NULL OR claimed<? OR owner=?)", (owner, now, bid, now - lease, owner)).rowcount > 0
+
+    async def claim(self, bid, owner, lease):
+        """Takes an unfinished broadcast nobody holds (or whose holder stopped renewing)."""
+        return await self.run(self._tx, self._claim, bid, owner, lease)
+
+    async def renew(self, bid, owner):
+        """False once another process has taken the broadcast over."""
+        return await self.run(lambda: self.conn.execute(
+            "UPDATE broadcasts SET claimed=? WHERE id=? AND owner=?",
+            (time.time(), bid, owner)).rowcount > 0)
+
+    def _load(self, bid):
+        row = self.conn.execute(
+            "SELECT event_id, text, report_chat_id, created FROM broadcasts WHERE id=?", (bid,)).fetchone()
+        pending = [r[0] for r in self.conn.execute(
+            "SELECT chat_id FROM broadcast_targets WHERE broadcast_id=? AND status='pending'", (bid,))]
+        return row, pending
+
+    async def load(self, bid):
+        return await self.run(self._load, bid)
+
+    def _checkpoint(self, bid, results):
+        self.conn.executemany(
+            "UPDATE broadcast_targets SET status=?, error=? WHERE broadcast_id=? AND chat_id=?",
+            [(status, err, bid, chat_id) for chat_id, status, err in results],
+        )
+
+    async def checkpoint(self, bid, results):
+        await self.run(self._tx, self._checkpoint, bid, results)
+
+    def _finish(self, bid):
+        self.conn.execute("UPDATE broadcasts SET finished=? WHERE id=?", (time.time(), bid))
+        return dict(self.conn.execute(
+            "SELECT status, COUNT(*) FROM broadcast_targets WHERE broadcast_id=? GROUP BY status", (bid,)))
+
+    async def finish(self, bid):
+        return await self.run(self._finish, bid)
+
+    async def unfinished(self):
+        return await self.run(lambda: [r[0] for r in self.conn.execute(
+            "SELECT id FROM broadcasts WHERE finished IS NULL ORDER BY id")])
+
+async def fan_out(targets, send_one, concurrency, on_result=None):
+    """Runs send_one(target) for every target (chat id, job, ...) with bounded concurrency.
+
+    Results are (target, status, error) with status sent|blocked|failed; on_result is
+    awaited for each of them (used for checkpoints / progress).
+    """
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(target):
+        async with sem:
+            try:
+                await send_one(target)
+                res = (target, "sent", None)
+            except Forbidden as e:
+                res = (target, "blocked", str(e))
+            except Exception as e:
+                res = (target, "failed", str(e))
+        if on_result:
+            await on_result(res)
+        return res
+
+    return await asyncio.gather(*(one(t) for t in targets))
+
+class Broadcaster:
+    """Sends one text to all approved registrants of an event, resumable after a crash.
+
+    Each broadcast is leased to one process (renewed while it sends); a broadcast whose
+    owner stopped renewing is taken over by the next resume pass in any process.
+    """
+    def __init__(self, store, registrations, concurrency, checkpoint_every, lease=120):
+        self.store = store
+        self.registrations = registrations
+        self.concurrency = concurrency
+        self.checkpoint_every = checkpoint_every
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.running = {}  # broadcast id -> task
+        self._watch_task = None
+
+    async def start(self, bot, ev_id, text, report_chat_id):
+        chat_ids = await self.registrations.approved_chat_ids(ev_id)
+        bid = await self.store.create(ev_id, text, report_chat_id, chat_ids, self.owner)
+        self.running[bid] = asyncio.create_task(self.run(bot, bid))
+        return bid, len(chat_ids)
+
+    async def resume_all(self, bot):
+        for bid in await self.store.unfinished():
+            if bid not in self.running and await self.store.claim(bid, self.owner, self.lease):
+                self.running[bid] = asyncio.create_task(self.run(bot, bid))
+
+    def watch(self, bot):
+        """Resumes interrupted broadcasts now and whenever a lease runs out."""
+        self._watch_task = asyncio.create_task(self._watch(bot))
+
+    async def _watch(self, bot):
+        while True:
+            try:
+                await self.resume_all(bot)
+            except Exception as e:
+                print(f"Broadcast resume error: {e}")
+            await asyncio.sleep(self.lease / 2)
+
+    async def _keep_lease(self, bid):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            if not await self.store.renew(bid, self.owner):
+                print(f"Broadcast #{bid}: lease lost, stopping here")
+                self.running[bid].cancel()
+                return
+
+    async def stop(self):
+        if self._watch_task:
+            self._watch_task.cancel()
+            await asyncio.gather(self._watch_task, return_exceptions=True)
+            self._watch_task = None
+        tasks = list(self.running.values())
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def run(self, bot, bid):
+        lease_task = asyncio.create_task(self._keep_lease(bid))
+        try:
+            row, pending = await self.store.load(bid)
+            ev_id, text, report_chat_id, _ = row
+            kwargs = {"rate_limit_args": {"priority": PRIORITY_BULK}} if send_scheduler else {}
+            buf = []
+            t0 = time.monotonic()
+
+            async def checkpoint(res):
+                buf.append(res)
+                if len(buf) >= self.checkpoint_every:
+                    batch = buf[:]
+                    buf.clear()
+                    await self.store.checkpoint(bid, batch)
+
+            try:
+                await fan_out(
+                    pending, lambda c: bot.send_message(chat_id=c, text=text, **kwargs),
+                    self.concurrency, checkpoint,
+                )
+            finally:
+                if buf:
+                    await self.store.checkpoint(bid, buf)
+            took = time.monotonic() - t0
+            counts = await self.store.finish(bid)
+            sent = counts.get("sent", 0)
+            report = (
+                f"📣 ارسال همگانی #{bid} ({ev_id}) تمام شد.\n"
+                f"✅ ارسال: {sent} | ⛔️ بلاک: {counts.get('blocked', 0)} | ⚠️ خطا: {counts.get('failed', 0)}\n"
+                f"⏱️ {took:.1f}s | {len(pending) / took if took > 0 else 0:.1f} پیام/ثانیه"
+            )
+            print(report)
+            if report_chat_id:
+                await bot.send_message(chat_id=report_chat_id, text=report)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Broadcast #{bid} error: {e}")
+        finally:
+            lease_task.cancel()
+            self.running.pop(bid, None)
+
+# =========================
+#        REMINDERS
+# =========================
+def parse_offsets(spec):
+    units = {"m": 60, "h": 3600, "d": 86400}
+    out = []
+    for part in spec.replace(" ", "").split(","):
+        if part and part[-1] in units and part[:-1].isdigit():
+            out.append(int(part[:-1]) * units[part[-1]])
+    return sorted(set(out), reverse=True)
+
+def event_start_ts(ev):
+    """Epoch seconds of the event start, or None if `when` can't be parsed."""
+    try:
+        dt = datetime.strptime(str(ev.get("when", "")).strip(), EVENT_TIME_FORMAT)
+    except ValueError:
+        return None
+    return dt.replace(tzinfo=ZoneInfo(EVENT_TIMEZONE)).timestamp()
+
+def offset_label(seconds):
+    if seconds % 86400 == 0:
+        return f"{seconds // 86400} روز"
+    if seconds % 3600 == 0:
+        return f"{seconds // 3600} ساعت"
+    return f"{seconds // 60} دقیقه"
+
+def reminder_text(ev, offset):
+    return (
+        f"⏰ یادآوری: «{ev.get('title','')}» {offset_label(offset)} دیگه شروع می‌شه.\n\n"
+        f"🕒 {ev.get('when','')}\n"
+        f"📍 {ev.get('place','—')}\n"
+        f"🗺️ {ev.get('maps','—')}"
+    )
+
+class ReminderStore(LocalStore):
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS reminders ("
+        " chat_id INTEGER NOT NULL, event_id TEXT NOT NULL, offset_s INTEGER NOT NULL,"
+        " due REAL NOT NULL, claimed REAL, sent REAL,"
+        " PRIMARY KEY (chat_id, event_id, offset_s))",
+        "CREATE INDEX IF NOT EXISTS reminders_unsent ON reminders(sent, due)",
+    )
+
+    def _add(self, jobs):
+        added = []
+        for job in jobs:
+            # primary key makes re-approval / double scheduling a no-op
+            if self.conn.execute(
+                "INSERT OR IGNORE INTO reminders(chat_id, event_id, offset_s, due) VALUES (?,?,?,?)", job
+            ).rowcount:
+                added.append(job)
+        return added
+
+    async def add(self, jobs):
+        return await self.run(self._tx, self._add, jobs)
+
+    async def cancel(self, chat_id, ev_id):
+        await self.run(lambda: self.conn.execute(
+            "DELETE FROM reminders WHERE chat_id=? AND event_id=? AND sent IS NULL", (chat_id, ev_id)))
+
+    def _claim(self, jobs, lease):
+        now = time.time()
+        won = []
+        for chat_id, ev_id, offset in jobs:
+            cur = self.conn.execute(
+                "UPDATE reminders SET claimed=? WHERE chat_id=? AND event_id=? AND offset_s=? "
+                "AND sent IS NULL AND (claimed IS NULL OR claimed < ?)",
+                (now, chat_id, ev_id, offset, now - lease),
+            )
+            if cur.rowcount:
+                won.append((chat_id, ev_id, offset))
+        return won
+
+    async def claim(self, jobs, lease=600):
+        """Marks jobs as taken by this worker; returns the ones nobody else holds."""
+        return await self.run(self._tx, self._claim, jobs, lease)
+
+    async def reschedule(self, chat_id, ev_id, offset, due):
+        await self.run(lambda: self.conn.execute(
+            "UPDATE reminders SET due=?, claimed=NULL WHERE chat_id=? AND event_id=? AND offset_s=?",
+            (due, chat_id, ev_id, offset)))
+
+    def _replan(self, due_of, lease):
+        now = time.time()
+        rows = self.conn.execute(
+            "SELECT due, chat_id, event_id, offset_s, claimed FROM reminders WHERE sent IS NULL").fetchall()
+        pending = []
+        for due, chat_id, ev_id, off, claimed in rows:
+            key = (chat_id, ev_id, off)
+            if claimed is not None and claimed >= now - lease:
+                pending.append((due, *key))  # being sent right now
+                continue
+            new_due = due_of(ev_id, off)
+            moved = new_due is not None and abs(new_due - due) > 1
+            if new_due is None or moved and new_due <= now:
+                # event removed, or moved so that this reminder's time is already over
+                self.conn.execute("DELETE FROM reminders WHERE chat_id=? AND event_id=? AND offset_s=?", key)
+                continue
+            if moved:
+                self.conn.execute(
+                    "UPDATE reminders SET due=?, claimed=NULL WHERE chat_id=? AND event_id=? AND offset_s=?",
+                    (new_due, *key))
+                due = new_due
+            pending.append((due, *key))
+        return pending
+
+    async def replan(self, due_of, lease=600):
+        """Moves unsent rows to due_of(event_id, offset) (None: drop the row); returns the pending jobs."""
+        return await self.run(self._tx, self._replan, due_of, lease)
+
+    async def drop(self, jobs):
+        await self.run(self._tx, lambda: self.conn.executemany(
+            "DELETE FROM reminders WHERE chat_id=? AND event_id=? AND offset_s=? AND sent IS NULL", jobs))
+
+    async def mark_sent(self, jobs):
+        now = time.time()
+        await self.run(self._tx, lambda: self.conn.executemany(
+            "UPDATE reminders SET sent=? WHERE chat_id=? AND event_id=? AND offset_s=?",
+            [(now, *j) for j in jobs]))
+
+class ReminderScheduler:
+    """Min-heap of due times; one task sleeps until the earliest job (O(log n) per job)."""
+    def __init__(self, store, offsets, concurrency):
+        self.store = store
+        self.offsets = offsets
+        self.concurrency = concurrency
+        self.heap = []
+        self.sent = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.bot = None
+
+    async def start(self, bot):
+        self.bot = bot
+        await self._replan()
+        self._task = asyncio.create_task(self._run())
+
+    async def resync(self):
+        """Re-plans pending jobs after the catalog changed (moved or removed events)."""
+        if self._task is None:
+            return  # start() plans them
+        await self._replan()
+        self._wakeup.set()
+
+    @staticmethod
+    def _due(ev_id, off):
+        ev = get_event(ev_id)
+        start = event_start_ts(ev) if ev else None
+        return None if start is None else start - off
+
+    async def _replan(self):
+        heap = [tuple(job) for job in await self.store.replan(self._due)]
+        heapq.heapify(heap)
+        self.heap = heap
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def schedule(self, chat_id, ev):
+        start = event_start_ts(ev) if ev else None
+        if start is None:
+            return 0
+        now = time.time()
+        jobs = [(chat_id, ev["id"], off, start - off) for off in self.offsets if start - off > now]
+        if jobs:
+            jobs = await self.store.add(jobs)
+            for chat_id, ev_id, off, due in jobs:
+                heapq.heappush(self.heap, (due, chat_id, ev_id, off))
+            self._wakeup.set()
+        return len(jobs)
+
+    async def cancel(self, chat_id, ev_id):
+        # heap entries are dropped lazily: claim() fails once the row is gone
+        await self.store.cancel(chat_id, ev_id)
+
+    async def _run(self):
+        while True:
+            timeout = None if not self.heap else max(0.0, self.heap[0][0] - time.time())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                continue  # a new job may be earlier than the current head
+            except asyncio.TimeoutError:
+                pass
+            now = time.time()
+            due = []
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap))
+            if due:
+                try:
+                    await self._fire(due)
+                except Exception as e:
+                    print(f"Reminder error: {e}")
+
+    async def _fire(self, due):
+        jobs, dropped = [], []
+        for old_due, chat_id, ev_id, off in due:
+            new_due = self._due(ev_id, off)
+            if new_due is not None and abs(new_due - old_due) > 1 and new_due > time.time():
+                # event moved later since the last resync
+                await self.store.reschedule(chat_id, ev_id, off, new_due)
+                heapq.heappush(self.heap, (new_due, chat_id, ev_id, off))
+            elif new_due is None or abs(new_due - old_due) > 1:
+                dropped.append((chat_id, ev_id, off))  # event removed, or its time is already over
+            else:
+                jobs.append((chat_id, ev_id, off))
+        if dropped:
+            await self.store.drop(dropped)
+        jobs = await self.store.claim(jobs)
+        if not jobs:
+            return
+        kwargs = {"rate_limit_args": {"priority": PRIORITY_BULK}} if send_scheduler else {}
+
+        async def send_one(job):
+            chat_id, ev_id, off = job
+            await self.bot.send_message(chat_id=chat_id, text=reminder_text(get_event(ev_id), off), **kwargs)
+
+        results = await fan_out(jobs, send_one, self.concurrency)
+        await self.store.mark_sent([job for job, status, _ in results if status != "failed"])
+        self.sent += sum(1 for _, status, _ in results if status == "sent")
+        retry_at = time.time() + 60
+        for job, status, _ in results:
+            if status == "failed":
+                await self.store.reschedule(*job, retry_at)
+                heapq.heappush(self.heap, (retry_at, *job))
+
+# =========================
+#     TABLE ASSIGNMENT
+# =========================
+LEVEL_ORDER = {label: i for i, label in enumerate(LEVELS.values())}
+
+def assign_tables(people, table_size, avoid=(), rounds=4, candidates=40, seed=0):
+    """Level-balanced conversation tables; returns a list of tables (lists of chat ids).
+
+    people: [(chat_id, level)], avoid: (a, b) pairs to keep apart (sat together before).
+    Greedy: walk everyone sorted by level and deal seats in snake order over the tables,
+    so sizes differ by at most one and every level is spread evenly. Local search: for
+    each person sharing a table with someone to avoid, try swaps with same-level people
+    at other tables (a same-level swap keeps the mix) and keep those that lower conflicts.
+    """
+    if not people:
+        return []
+    k = -(-len(people) // table_size)
+    order = sorted(people, key=lambda p: (LEVEL_ORDER.get(p[1], len(LEVEL_ORDER)), p[0]))
+    snake = itertools.cycle(list(range(k)) + list(range(k - 1, -1, -1)))
+    tables = [set() for _ in range(k)]
+    seat, level_of, by_level = {}, {}, {}
+    for (cid, level), t in zip(order, snake):
+        tables[t].add(cid)
+        seat[cid] = t
+        level_of[cid] = level
+        by_level.setdefault(level, []).append(cid)
+
+    avoid_of = {}
+    for a, b in avoid:
+        if a in seat and b in seat and a != b:
+            avoid_of.setdefault(a, set()).add(b)
+            avoid_of.setdefault(b, set()).add(a)
+
+    def conflicts(cid, t, without=None):
+        return sum(1 for o in avoid_of.get(cid, ()) if seat[o] == t and o != without)
+
+    rng = random.Random(seed)
+    for _ in range(rounds):
+        improved = False
+        for cid in list(avoid_of):
+            t1 = seat[cid]
+            now = conflicts(cid, t1)
+            if not now:
+                continue
+            pool = by_level[level_of[cid]]
+            for q in rng.sample(pool, min(candidates, len(pool))):
+                t2 = seat[q]
+                if t2 == t1:
+                    continue
+                before = now + conflicts(q, t2)
+                after = conflicts(cid, t2, without=q) + conflicts(q, t1, without=cid)
+                if after < before:
+                    tables[t1].remove(cid)
+                    tables[t2].remove(q)
+                    tables[t1].add(q)
+                    tables[t2].add(cid)
+                    seat[cid], seat[q] = t2, t1
+                    improved = True
+                    break
+        if not improved:
+            break
+    return [sorted(t) for t in tables]
+
+def table_report(tables, level_of, avoid=()):
+    """Conflicting pairs still seated together and the largest per-table level deviation."""
+    seat = {cid: i for i, t in enumerate(tables) for cid in t}
+    conflicts = sum(1 for a, b in avoid if a in seat and b in seat and a != b and seat[a] == seat[b])
+    totals = {}
+    for lvl in level_of.values():
+        totals[lvl] = totals.get(lvl, 0) + 1
+    deviation = 0.0
+    for t in tables:
+        for lvl, total in totals.items():
+            share = total * len(t) / len(seat)
+            deviation = max(deviation, abs(sum(1 for c in t if level_of[c] == lvl) - share))
+    return {"tables": len(tables), "people": len(seat), "conflicts": conflicts,
+            "max_level_deviation": round(deviation, 2)}
+
+class TableStore(LocalStore):
+    """Seats per event plus every pair that has shared a table (used to keep them apart later)."""
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS table_seats ("
+        " event_id TEXT NOT NULL, chat_id INTEGER NOT NULL, table_no INTEGER NOT NULL,"
+        " PRIMARY KEY (event_id, chat_id))",
+        "CREATE TABLE IF NOT EXISTS table_pairs ("
+        " event_id TEXT NOT NULL, a INTEGER NOT NULL, b INTEGER NOT NULL,"
+        " PRIMARY KEY (event_id, a, b))",
+        "CREATE INDEX IF NOT EXISTS table_pairs_a ON table_pairs(a)",
+    )
+
+    @staticmethod
+    def _pairs(ev_id, members):
+        return [(ev_id, a, b) for a, b in itertools.combinations(sorted(members), 2)]
+
+    async def avoid_pairs(self, ev_id, chat_ids):
+        """Pairs among chat_ids that sat together at another event."""
+        ids = set(chat_ids)
+        rows = await self.run(lambda: self.conn.execute(
+            "SELECT DISTINCT a, b FROM table_pairs WHERE event_id != ?", (ev_id,)).fetchall())
+        return [(a, b) for a, b in rows if a in ids and b in ids]
+
+    def _save(self, ev_id, tables):
+        self.conn.execute("DELETE FROM table_seats WHERE event_id=?", (ev_id,))
+        self.conn.execute("DELETE FROM table_pairs WHERE event_id=?", (ev_id,))
+        self.conn.executemany("INSERT INTO table_seats(event_id, chat_id, table_no) VALUES (?,?,?)",
+                              [(ev_id, cid, i) for i, t in enumerate(tables, start=1) for cid in t])
+        self.conn.executemany("INSERT INTO table_pairs(event_id, a, b) VALUES (?,?,?)",
+                              [p for t in tables for p in self._pairs(ev_id, t)])
+
+    async def save(self, ev_id, tables):
+        """Replaces the event's seating; returns the previous {chat_id: table_no}."""
+        previous = await self.seats(ev_id)
+        await self.run(self._tx, self._save, ev_id, tables)
+        return previous
+
+    async def seats(self, ev_id):
+        return await self.run(lambda: dict(self.conn.execute(
+            "SELECT chat_id, table_no FROM table_seats WHERE event_id=?", (ev_id,))))
+
+    def _seat_late(self, ev_id, chat_id, table_size):
+        row = self.conn.execute(
+            "SELECT table_no FROM table_seats WHERE event_id=? AND chat_id=?", (ev_id, chat_id)).fetchone()
+        if row:
+            return row[0]
+        rows = self.conn.execute(
+            "SELECT s.chat_id, s.table_no, r.level FROM table_seats s LEFT JOIN registrations r "
+            "ON r.event_id = s.event_id AND r.chat_id = s.chat_id WHERE s.event_id=?", (ev_id,)).fetchall()
+        if not rows:
+            return None  # no seating for this event yet
+        level = (self.conn.execute("SELECT level FROM registrations WHERE event_id=? AND chat_id=?",
+                                   (ev_id, chat_id)).fetchone() or (None,))[0]
+        avoid = {b if a == chat_id else a for a, b in self.conn.execute(
+            "SELECT a, b FROM table_pairs WHERE event_id != ? AND (a=? OR b=?)", (ev_id, chat_id, chat_id))}
+        tables = {}
+        for cid, t, lvl in rows:
+            tables.setdefault(t, []).append((cid, lvl))
+        # smallest table first, then fewest people to avoid, then fewest of the same level
+        best = min(tables, key=lambda t: (len(tables[t]), sum(1 for c, _ in tables[t] if c in avoid),
+                                          sum(1 for _, lvl in tables[t] if lvl == level), t))
+        if len(tables[best]) >= table_size:
+            best = max(tables) + 1
+            tables[best] = []
+        self.conn.execute("INSERT INTO table_seats(event_id, chat_id, table_no) VALUES (?,?,?)",
+                          (ev_id, chat_id, best))
+        self.conn.executemany("INSERT OR IGNORE INTO table_pairs(event_id, a, b) VALUES (?,?,?)",
+                              [(ev_id, min(c, chat_id), max(c, chat_id)) for c, _ in tables[best]])
+        return best
+
+    async def seat_late(self, ev_id, chat_id, table_size):
+        """Seats a user approved after /tables ran (best-fitting table); None if no seating yet."""
+        return await self.run(self._tx, self._seat_late, ev_id, chat_id, table_size)
+
+    @staticmethod
+    def unseat(conn, ev_id, chat_id):
+        """Removes a seat and its pairs inside the caller's transaction (RegistrationStore releases)."""
+        conn.execute("DELETE FROM table_seats WHERE event_id=? AND chat_id=?", (ev_id, chat_id))
+        conn.execute("DELETE FROM table_pairs WHERE event_id=? AND (a=? OR b=?)", (ev_id, chat_id, chat_id))
+
+# =========================
+#          OUTBOX
+# =========================
+OUTBOX_DELIVERIES = CounterMetric("cbot_outbox_total", "Outbox delivery attempts by result", ("result",))
+
+class OutboxStore(LocalStore):
+    """Notifications waiting for delivery; sent rows are kept for a while, then purged.
+
+    dedup_key is unique, so enqueuing the same notification again (redelivered update,
+    handler re-run) stores it once. Dispatchers in several processes claim rows with a lease
+    (owner, claimed); the owner renews it right before sending each row.
+    """
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS outbox ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT, dedup_key TEXT NOT NULL UNIQUE,"
+        " chat_id INTEGER NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL,"
+        " next_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, claimed REAL,"
+        " sent REAL, dead INTEGER NOT NULL DEFAULT 0, last_error TEXT)",
+        "CREATE INDEX IF NOT EXISTS outbox_due ON outbox(sent, dead, next_at)",
+    )
+
+    def __init__(self, path):
+        super().__init__(path)
+        # batch: groups the messages of one bulk action so its progress can be followed
+        cols = {r[1] for r in self.conn.execute("PRAGMA table_info(outbox)")}
+        if "batch" not in cols:
+            self.conn.execute("ALTER TABLE outbox ADD COLUMN batch TEXT")
+        if "owner" not in cols:
+            self.conn.execute("ALTER TABLE outbox ADD COLUMN owner TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS outbox_batch ON outbox(batch)")
+
+    @staticmethod
+    def insert(conn, rows):
+        """Stores rows on conn inside the caller's transaction (other stores share the database)."""
+        now = time.time()
+        conn.executemany(
+            "INSERT OR IGNORE INTO outbox(dedup_key, chat_id, payload, batch, created, next_at) "
+            "VALUES (?,?,?,?,?,?)", [(*r, now, now) for r in rows])
+
+    async def append(self, rows):
+        """rows: (dedup_key, chat_id, payload_json, batch); one transaction for the whole batch."""
+        await self.run(self._tx, self.insert, self.conn, rows)
+
+    async def batch_progress(self, batch):
+        """(sent, given up) for the messages of one batch."""
+        sent, dead = await self.run(lambda: self.conn.execute(
+            "SELECT COUNT(sent), COALESCE(SUM(dead), 0) FROM outbox WHERE batch=?", (batch,)).fetchone())
+        return sent, dead
+
+    @staticmethod
+    def _not_busy(busy):
+        return f" AND chat_id NOT IN ({','.join('?' * len(busy))})" if busy else ""
+
+    def _claim(self, limit, owner, lease, per_chat, busy):
+        now = time.time()
+        # at most per_chat rows of one chat: a slow chat (admin group) can't fill the whole claim
+        rows = self.conn.execute(
+            "SELECT id, chat_id, payload, attempts FROM ("
+            " SELECT id, chat_id, payload, attempts, next_at,"
+            " ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY next_at, id) AS n FROM outbox"
+            " WHERE sent IS NULL AND dead=0 AND next_at<=? AND (claimed IS NULL OR claimed<?)"
+            + self._not_busy(busy) + ") WHERE n<=? ORDER BY next_at, id LIMIT ?",
+            (now, now - lease, *busy, per_chat, limit)).fetchall()
+        self.conn.executemany("UPDATE outbox SET claimed=?, owner=? WHERE id=?", [(now, owner, r[0]) for r in rows])
+        return rows
+
+    async def claim(self, limit, owner, lease=120, per_chat=5, busy=()):
+        """Due rows not leased by anyone, skipping the chats in busy (already being sent here)."""
+        return await self.run(self._tx, self._claim, limit, owner, lease, per_chat, list(busy))
+
+    def _renew(self, row_id, owner):
+        return self.conn.execute(
+            "UPDATE outbox SET claimed=? WHERE id=? AND owner=? AND sent IS NULL",
+            (time.time(), row_id, owner)).rowcount == 1
+
+    async def renew(self, row_id, owner):
+        """Restarts the lease on a row about to be sent; False if another process took it over."""
+        return await self.run(self._renew, row_id, owner)
+
+    def _finish(self, sent, retry, dead):
+        now = time.time()
+        self.conn.executemany("UPDATE outbox SET sent=?, claimed=NULL WHERE id=?", [(now, i) for i in sent])
+        self.conn.executemany(
+            "UPDATE outbox SET attempts=attempts+1, next_at=?, claimed=NULL, last_error=? WHERE id=?", retry)
+        self.conn.executemany(
+            "UPDATE outbox SET attempts=attempts+1, dead=1, claimed=NULL, last_error=? WHERE id=?", dead)
+
+    async def finish(self, sent, retry, dead):
+        """sent: ids; retry: (next_at, error, id); dead: (error, id). One transaction."""
+        await self.run(self._tx, self._finish, sent, retry, dead)
+
+    async def next_due(self, lease=120, busy=()):
+        """Earliest next_at among rows claim() could take (leased rows and busy chats excluded)."""
+        busy = list(busy)
+        return await self.run(lambda: self.conn.execute(
+            "SELECT MIN(next_at) FROM outbox WHERE sent IS NULL AND dead=0 AND (claimed IS NULL OR claimed<?)"
+            + self._not_busy(busy), (time.time() - lease, *busy)).fetchone()[0])
+
+    async def purge(self, older_than):
+        await self.run(lambda: self.conn.execute(
+            "DELETE FROM outbox WHERE sent IS NOT NULL AND sent < ?", (time.time() - older_than,)))
+
+class Outbox:
+    """Transactional outbox: enqueue() returns once the message is stored, delivery is
+    at-least-once by a background dispatcher with exponential backoff.
+
+    Writes are group-committed: callers arriving while a commit runs are stored together
+    in the next transaction instead of one commit each.
+
+    Delivery runs in one lane per chat (rows of a chat in order, each finished on its own),
+    so a paced chat such as the admin group doesn't hold up confirmations to users.
+    """
+    def __init__(self, store, batch, concurrency, max_attempts, max_backoff, base_backoff=2.0,
+                 lease=120, per_chat=5):
+        self.store = store
+        self.batch = batch
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.base_backoff = base_backoff
+        self.lease = lease
+        self.per_chat = per_chat
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.waiting = []  # ((key, chat_id, payload), future) not committed yet
+        self._commit_task = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._next_purge = 0.0
+        self.lanes = {}  # chat_id -> task sending that chat's claimed rows
+        self.inflight = 0
+        self._slots = None
+        self.bot = None
+
+    async def enqueue(self, key, chat_id, text, reply_markup=None, parse_mode=None):
+        await self.enqueue_many([(key, chat_id, text, reply_markup, parse_mode)])
+
+    async def enqueue_many(self, messages, batch=None):
+        """messages: (key, chat_id, text, reply_markup, parse_mode); stored in one commit."""
+        if not messages:
+            return
+        fut = asyncio.get_running_loop().create_future()
+        for key, chat_id, text, reply_markup, parse_mode in messages:
+            self.waiting.append((self.row(key, chat_id, text, reply_markup, parse_mode, batch), fut))
+        if self._commit_task is None or self._commit_task.done():
+            self._commit_task = asyncio.create_task(self._commit())
+        await fut
+
+    @staticmethod
+    def row(key, chat_id, text, reply_markup=None, parse_mode=None, batch=None):
+        """OutboxStore row for one message."""
+        payload = json.dumps({
+            "text": text, "parse_mode": parse_mode,
+            "reply_markup": reply_markup.to_dict() if reply_markup else None,
+        }, ensure_ascii=False)
+        return key, chat_id, payload, batch
+
+    def notify(self):
+        """Wakes the dispatcher for rows another store wrote in its own transaction."""
+        self._wakeup.set()
+
+    async def _commit(self):
+        while self.waiting:
+            batch, self.waiting = self.waiting, []
+            try:
+                await self.store.append([row for row, _ in batch])
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_result(None)
+            self._wakeup.set()
+
+    def start(self, bot):
+        self.bot = bot
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._commit_task:
+            await asyncio.gather(self._commit_task, return_exceptions=True)
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # unsent claimed rows go back to the pool when their lease runs out
+        lanes = list(self.lanes.values())
+        for task in lanes:
+            task.cancel()
+        await asyncio.gather(*lanes, return_exceptions=True)
+
+    async def _deliver(self, row):
+        _, chat_id, payload, _ = row
+        msg = json.loads(payload)
+        markup = msg.get("reply_markup")
+        await self.bot.send_message(
+            chat_id=chat_id, text=msg["text"], parse_mode=msg.get("parse_mode"),
+            reply_markup=InlineKeyboardMarkup.de_json(markup, self.bot) if markup else None,
+        )
+
+    def _backoff(self, attempts):
+        # full jitter keeps retries from many rows from landing together
+        return min(self.max_backoff, self.base_backoff * 2 ** attempts) * random.uniform(0.5, 1.0)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                room = self.batch - self.inflight
+                rows = await self.store.claim(room, self.owner, self.lease, self.per_chat, self.lanes) if room > 0 else []
+                if rows:
+                    by_chat = {}
+                    for row in rows:
+                        by_chat.setdefault(row[1], []).append(row)
+                    for chat_id, chat_rows in by_chat.items():
+                        self._start_lane(chat_id, chat_rows)
+                    continue
+                if time.time() > self._next_purge:
+                    await self.store.purge(7 * 86400)
+                    self._next_purge = time.time() + 3600
+                next_due = await self.store.next_due(self.lease, self.lanes) if room > 0 else None
+            except Exception as e:
+                print(f"Outbox error: {e}")
+                next_due = time.time() + 5
+            # lanes finishing and new rows wake us; other processes' rows and expired leases
+            # are picked up by the periodic poll
+            timeout = 30.0 if next_due is None else min(30.0, max(0.0, next_due - time.time()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start_lane(self, chat_id, rows):
+        self.inflight += len(rows)
+        self.lanes[chat_id] = asyncio.create_task(self._lane(chat_id, rows))
+
+    async def _lane(self, chat_id, rows):
+        try:
+            for row in rows:
+                try:
+                    async with self._slots:
+                        await self._send_row(row)
+                except Exception as e:
+                    # lease runs out and the row is claimed again
+                    print(f"Outbox error on #{row[0]}: {e}")
+                finally:
+                    self.inflight -= 1
+        finally:
+            self.lanes.pop(chat_id, None)
+            self._wakeup.set()
+
+    async def _send_row(self, row):
+        row_id, chat_id, _, attempts = row
+        # a row can wait behind its chat's pacing: take a fresh lease right before sending it
+        if not await self.store.renew(row_id, self.owner):
+            return  # our lease ran out and another process owns the row now
+        try:
+            await self._deliver(row)
+            status, err = "sent", None
+        except Forbidden as e:
+            status, err = "blocked", str(e)
+        except Exception as e:
+            status, err = "failed", str(e)
+        OUTBOX_DELIVERIES.inc(status)
+        if status == "sent":
+            await self.store.finish([row_id], [], [])
+        elif status == "blocked" or attempts + 1 >= self.max_attempts:
+            print(f"Outbox: giving up on #{row_id} to {chat_id}: {err}")
+            await self.store.finish([], [], [(err, row_id)])
+        else:
+            await self.store.finish([], [(time.time() + self._backoff(attempts), err, row_id)], [])
+
+# =========================
+#     UPDATE DEDUPLICATION
+# =========================
+class UpdateDeduper:
+    """Bounded LRU/TTL set of seen update_ids, optionally backed by a shared SQLite table."""
+    def __init__(self, maxsize, ttl, path=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.recent = OrderedDict()  # update_id -> first seen (monotonic)
+        self.duplicates = 0
+        self.conn = None
+        self.inserts = 0
+        if path:
+            self.conn = db_connect(path)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS seen_updates (update_id INTEGER PRIMARY KEY, seen REAL NOT NULL)")
+            self.lock = threading.Lock()
+
+    def _remember_shared(self, update_id):
+        with self.lock:
+            new = self.conn.execute(
+                "INSERT OR IGNORE INTO seen_updates(update_id, seen) VALUES (?,?)", (update_id, time.time())
+            ).rowcount == 1
+            self.inserts += 1
+            if self.inserts % 1000 == 0:
+                self.conn.execute("DELETE FROM seen_updates WHERE seen < ?", (time.time() - self.ttl,))
+        return new
+
+    async def remember(self, update_id):
+        """True the first time an update_id is seen (by any worker), False for redeliveries."""
+        now = time.monotonic()
+        seen = self.recent.get(update_id)
+        if seen is not None and now - seen < self.ttl:
+            self.duplicates += 1
+            return False
+        self.recent[update_id] = now
+        self.recent.move_to_end(update_id)
+        while len(self.recent) > self.maxsize:
+            self.recent.popitem(last=False)
+        if self.conn is not None and not await asyncio.to_thread(self._remember_shared, update_id):
+            self.duplicates += 1
+            return False
+        return True
+
+    async def forget(self, update_id):
+        # the update was not accepted after all (e.g. queue full); let the redelivery through
+        self.recent.pop(update_id, None)
+        if self.conn is not None:
+            def _delete():
+                with self.lock:
+                    self.conn.execute("DELETE FROM seen_updates WHERE update_id=?", (update_id,))
+            await asyncio.to_thread(_delete)
+
+# =========================
+#         SESSIONS
+# =========================
+SESSIONS_EVICTED = CounterMetric("cbot_sessions_evicted_total", "user_data dropped", ("reason",))
+SESSIONS_EXPIRED = CounterMetric("cbot_sessions_expired_total", "Returning users whose unfinished flow had expired")
+
+class SessionTracker:
+    """Last activity per user (oldest first) over application.user_data.
+
+    Idle users are dropped lazily when they come back and by a periodic sweep; the
+    live count is capped with LRU eviction. Users whose unfinished flow was dropped
+    are remembered (bounded) so their next update can get a "session expired" note.
+    """
+    def __init__(self, ttl, max_sessions):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.seen = OrderedDict()     # user_id -> last activity (monotonic)
+        self.expired = OrderedDict()  # user_id -> None; evicted mid-flow, not back yet
+        self.app = None
+        self._task = None
+
+    def _evict(self, user_id, reason):
+        ud = self.app.user_data.get(user_id)
+        if ud and ud.get("nav"):
+            self.expired[user_id] = None
+            while len(self.expired) > self.max_sessions:
+                self.expired.popitem(last=False)
+        # also deletes the persisted row on the next persistence flush
+        self.app.drop_user_data(user_id)
+        SESSIONS_EVICTED.inc(reason)
+
+    def touch(self, user_id):
+        """Records activity; True if the user had an unfinished flow that has expired."""
+        now = time.monotonic()
+        last = self.seen.pop(user_id, None)
+        self.seen[user_id] = now
+        expired = user_id in self.expired
+        if expired:
+            del self.expired[user_id]
+        if last is not None and now - last > self.ttl:
+            # idle past the TTL but not swept yet: the caller clears the flow
+            ud = self.app.user_data.get(user_id)
+            if ud and ud.get("nav"):
+                expired = True
+                SESSIONS_EVICTED.inc("ttl")
+        while len(self.seen) > self.max_sessions:
+            self._evict(self.seen.popitem(last=False)[0], "lru")
+        return expired
+
+    def sweep(self):
+        cutoff = time.monotonic() - self.ttl
+        while self.seen:
+            user_id, last = next(iter(self.seen.items()))
+            if last > cutoff:
+                break
+            del self.seen[user_id]
+            self._evict(user_id, "ttl")
+
+    def start(self, app, interval):
+        self.app = app
+        # users loaded from persistence start with a full TTL
+        now = time.monotonic()
+        for user_id in list(app.user_data):
+            self.seen[user_id] = now
+        while len(self.seen) > self.max_sessions:
+            self._evict(self.seen.popitem(last=False)[0], "lru")
+        self._task = asyncio.create_task(self._sweep_loop(interval))
+
+    async def _sweep_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Session sweep error: {e}")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+async def session_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # group -1: runs before every handler; only private chats hold a flow
+    user, chat = update.effective_user, update.effective_chat
+    if not user or not chat or chat.type != "private":
+        return
+    if not sessions.touch(user.id):
+        return
+    clear_flow(context)
+    SESSIONS_EXPIRED.inc()
+    text = update.message.text if update.message else None
+    if text and (text.startswith("/start") or text == "شروع مجدد 🔄"):
+        return  # starting over anyway
+    await chat.send_message("⌛ جلسه‌ی قبلیت به خاطر عدم فعالیت منقضی شد؛ لطفاً از اول شروع کن.", reply_markup=reply_main)
+    if update.callback_query:
+        await update.callback_query.answer()
+    await render_home(update, context)
+    raise ApplicationHandlerStop
+
+# =========================
+#   ASYNC UPDATE QUEUE
+# =========================
+# Each chat is pinned to one shard (chat_id % workers), so updates of one user are
+# processed strictly in order, while different users are handled concurrently.
+class UpdateQueue:
+    def __init__(self, app, workers, maxsize):
+        self.app = app
+        self.workers = workers
+        per_shard = max(1, maxsize // workers)
+        self.shards = [asyncio.Queue(maxsize=per_shard) for _ in range(workers)]
+        self.tasks = []
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=1000)  # seconds, enqueue -> processed
+
+    @staticmethod
+    def chat_key(update: Update):
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return 0
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._worker(q)) for q in self.shards]
+
+    async def stop(self):
+        # drain what is already accepted (Telegram got 200 for these), then stop workers
+        for q in self.shards:
+            await q.join()
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def put(self, update: Update):
+        """Returns False when the shard is full (caller should signal backpressure)."""
+        # the router already split chats on chat_id % CBOT_WORKERS, so every chat here has the
+        # same remainder: shard on the quotient, or only 1/gcd of the shards would get work
+        q = self.shards[(self.chat_key(update) // CBOT_WORKERS) % self.workers]
+        try:
+            q.put_nowait((time.monotonic(), update))
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+    async def _worker(self, q):
+        IN_UPDATE.set(True)  # this task only runs handlers
+        while True:
+            enqueued_at, update = await q.get()
+            try:
+                await self.app.process_update(update)
+                if isinstance(self.app.persistence, SQLitePersistence):
+                    await self.app.persistence.write_through(self.app)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Update processing error: {e}")
+            finally:
+                self.latencies.append(time.monotonic() - enqueued_at)
+                q.task_done()
+
+    def depth(self):
+        return sum(q.qsize() for q in self.shards)
+
+    def stats(self):
+        lat = sorted(self.latencies)
+
+        def pct(p):
+            return round(lat[min(len(lat) - 1, int(p * len(lat)))] * 1000, 1) if lat else 0.0
+
+        return {
+            "depth": self.depth(),
+            "capacity": sum(q.maxsize for q in self.shards),
+            "workers": self.workers,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "latency_ms": {"p50": pct(0.50), "p95": pct(0.95), "p99": pct(0.99)},
+        }
 
 # =========================
 #  PTB App + FastAPI App
 # =========================
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is not set")
-application = ApplicationBuilder().token(BOT_TOKEN).build()
+builder = (ApplicationBuilder().token(BOT_TOKEN)
+           .request(InstrumentedRequest(connection_pool_size=256))
+           .get_updates_request(InstrumentedRequest()))  # unused with webhooks; avoids a second CA load
+if BOT_API_BASE_URL:
+    builder = builder.base_url(f"{BOT_API_BASE_URL.rstrip('/')}/bot")
+send_scheduler = None
+if SEND_RATE_LIMIT:
+    send_scheduler = SendScheduler(
+        SEND_GLOBAL_RATE, SEND_PRIVATE_CHAT_RATE, SEND_GROUP_CHAT_RATE,
+        admin_chat_id=GROUP_CHAT_ID, coalesce=SEND_COALESCE,
+    )
+    builder = builder.rate_limiter(send_scheduler)
+if STATE_BACKEND == "sqlite":
+    builder = builder.persistence(SQLitePersistence(DB_PATH, update_interval=STATE_FLUSH_INTERVAL))
+application = builder.build()
+
+registrations = RegistrationStore(DB_PATH)
+reminders = ReminderScheduler(ReminderStore(DB_PATH), parse_offsets(REMINDER_OFFSETS), BROADCAST_CONCURRENCY) \
+    if REMINDERS_ENABLED else None
+broadcaster = Broadcaster(BroadcastStore(DB_PATH), registrations, BROADCAST_CONCURRENCY, BROADCAST_CHECKPOINT_EVERY)
+tables = TableStore(DB_PATH)
+outbox = Outbox(OutboxStore(DB_PATH), OUTBOX_BATCH, BROADCAST_CONCURRENCY, OUTBOX_MAX_ATTEMPTS, OUTBOX_MAX_BACKOFF)
+
+sessions = SessionTracker(SESSION_TTL, SESSION_MAX)
 
 # Handlers (order matters)
+application.add_handler(TypeHandler(Update, session_guard), group=-1)
 application.add_handler(CommandHandler("start", start))
+application.add_handler(CommandHandler("reload", reload_command))
+application.add_handler(CommandHandler("broadcast", broadcast_command))
+application.add_handler(CommandHandler("stats", stats_command))
+application.add_handler(CommandHandler("review", review_command))
+application.add_handler(CommandHandler("tables", tables_command))
 # حذف /cancel؛ فقط شورتکات شروع مجدد
 application.add_handler(MessageHandler(filters.TEXT & filters.Regex("^شروع مجدد 🔄$"), restart_shortcut))
 
 # Callbacks
-application.add_handler(CallbackQueryHandler(handle_level, pattern=r"^lvl_"))  # must be before generic
-application.add_handler(CallbackQueryHandler(handle_callback))
+application.add_handler(CallbackQueryHandler(handle_callback))  # table-driven: CALLBACK_ROUTES / PREFIX_ROUTES
 
 # Contact & free text
 application.add_handler(MessageHandler(filters.CONTACT, handle_contact))
 application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
+async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    HANDLER_ERRORS.inc("unhandled")
+    print(f"Unhandled error: {context.error!r}")
+
+application.add_error_handler(on_error)
+
+update_queue = UpdateQueue(application, UPDATE_WORKERS, UPDATE_QUEUE_SIZE) if WEBHOOK_ASYNC else None
+deduper = UpdateDeduper(UPDATE_DEDUP_SIZE, UPDATE_DEDUP_TTL, DB_PATH if STATE_BACKEND == "sqlite" else None)
+
+# Gauges and callback counters read existing values at scrape time (nothing extra on the hot path)
+GaugeMetric("cbot_startup_ready_seconds", "Process start to serving", lambda: (STARTUP.ready_ms or 0) / 1000)
+GaugeMetric("cbot_active_sessions", "Users with an unfinished registration flow",
+            lambda: sum(1 for ud in application.user_data.values() if ud.get("nav")))
+GaugeMetric("cbot_sessions_live", "Users with user_data in memory", lambda: len(sessions.seen))
+CallbackCounterMetric("cbot_duplicate_updates_total", "Redelivered updates dropped", lambda: deduper.duplicates)
+if update_queue:
+    GaugeMetric("cbot_update_queue_depth", "Updates waiting for a worker", update_queue.depth)
+    CallbackCounterMetric("cbot_update_queue_rejected_total", "Updates rejected with 503 (queue full)", lambda: update_queue.rejected)
+    CallbackCounterMetric("cbot_update_queue_processed_total", "Updates processed by workers", lambda: update_queue.processed)
+if send_scheduler:
+    GaugeMetric("cbot_send_queued", "Outgoing calls waiting for rate budget",
+                lambda: sum(len(q) for q in send_scheduler.pending.values()))
+    CallbackCounterMetric("cbot_send_retry_after_total", "429 responses from Telegram", lambda: send_scheduler.retry_after_count)
+    CallbackCounterMetric("cbot_send_coalesced_total", "Messages merged into a previous send", lambda: send_scheduler.coalesced)
+if sheet_sink:
+    GaugeMetric("cbot_sheet_buffered_rows", "Rows waiting for the next sheet flush", lambda: len(sheet_sink.buffer))
+if reminders:
+    GaugeMetric("cbot_reminders_pending", "Reminder jobs in the in-memory heap", lambda: len(reminders.heap))
+
+STARTUP.mark("build_app")
+
+async def ensure_webhook(bot):
+    """Registers WEBHOOK_URL unless Telegram already has it (saves a call on most boots)."""
+    t0 = time.perf_counter()
+    try:
+        if WEBHOOK_SETUP != "always":
+            try:
+                if (await bot.get_webhook_info()).url == WEBHOOK_URL:
+                    return False
+            except Exception as e:
+                print(f"get_webhook_info error: {e}")
+        await bot.set_webhook(url=WEBHOOK_URL)
+        return True
+    finally:
+        STARTUP.phases["webhook"] = round((time.perf_counter() - t0) * 1000, 1)
+
+webhook_task = None
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global webhook_task
+    STARTUP.mark("server")  # import done -> ASGI server calls the lifespan
+    if catalog_reloader:
+        # first load happens before serving; a broken file keeps the env/default catalog
+        await catalog_reloader.reload(force=True)
+        catalog_reloader.start()
+    STARTUP.mark("catalog")
     await application.initialize()
-    if WEBHOOK_URL:
-        await application.bot.set_webhook(url=WEBHOOK_URL)
+    STARTUP.mark("initialize")
+    # multi-process: WEBHOOK_URL points at router.py; one process registers it
+    if WEBHOOK_URL and CBOT_WORKER_ID == 0 and WEBHOOK_SETUP == "background":
+        webhook_task = asyncio.create_task(ensure_webhook(application.bot))
+    elif WEBHOOK_URL and CBOT_WORKER_ID == 0 and WEBHOOK_SETUP != "off":
+        await ensure_webhook(application.bot)
+    STARTUP.last = time.perf_counter()
     await application.start()
+    STARTUP.mark("start")
+    if send_scheduler and CBOT_WORKERS > 1:
+        send_scheduler.start_budget(SendBudgetStore(DB_PATH), CBOT_WORKER_ID, SEND_BUDGET_INTERVAL)
+    sessions.start(application, SESSION_SWEEP_INTERVAL)
+    outbox.start(application.bot)
+    phones_task = asyncio.create_task(registrations.load_phones())  # off the startup path
+    if sheet_sink:
+        sheet_sink.start()
+    if update_queue:
+        update_queue.start()
+    # interrupted broadcasts: each is claimed by one process (lease), whichever gets it first
+    broadcaster.watch(application.bot)
+    if reminders:
+        await reminders.start(application.bot)
+    STARTUP.mark("services")
+    STARTUP.ready()
     yield
+    if webhook_task:
+        webhook_task.cancel()
+        await asyncio.gather(webhook_task, return_exceptions=True)
+    await asyncio.gather(phones_task, return_exceptions=True)
+    if reminders:
+        await reminders.stop()
+    await broadcaster.stop()
+    await stop_bulk_progress()
+    await outbox.stop()
+    if update_queue:
+        await update_queue.stop()
+    if sheet_sink:
+        await sheet_sink.stop()
+    if catalog_reloader:
+        await catalog_reloader.stop()
+    await sessions.stop()
     await application.stop()
     await application.shutdown()
 
@@ -552,10 +3982,74 @@ app = FastAPI(lifespan=lifespan)
 @app.post("/")
 async def webhook(request: Request):
     body = await request.json()
+    update_id = body.get("update_id")
+    if update_id is not None and not await deduper.remember(update_id):
+        return {"status": "duplicate"}
     update = Update.de_json(body, application.bot)
-    await application.process_update(update)
+    if STARTUP.first_update_ms is None:
+        STARTUP.first_update_ms = STARTUP.since_start()
+    if update_queue is None:
+        token = IN_UPDATE.set(True)
+        try:
+            await application.process_update(update)
+            if isinstance(application.persistence, SQLitePersistence):
+                await application.persistence.write_through(application)
+        except Exception:
+            if update_id is not None:
+                await deduper.forget(update_id)
+            raise
+        finally:
+            IN_UPDATE.reset(token)
+    elif not update_queue.put(update):
+        if update_id is not None:
+            await deduper.forget(update_id)
+        # queue full: non-2xx makes Telegram redeliver later instead of us dropping it
+        return Response(status_code=503, headers={"Retry-After": "1"})
     return {"status": "ok"}
 
 @app.get("/")
 async def root():
     return {"status": "CBot (webhook) is running."}
+
+@app.get("/startup")
+async def startup_stats():
+    return STARTUP.report()
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+def check_admin_token(request: Request):
+    if not ADMIN_API_TOKEN:
+        raise HTTPException(status_code=404)
+    # constant-time comparison: response timing must not reveal how much of the token matched
+    if not hmac.compare_digest(request.headers.get("authorization", "").encode(), f"Bearer {ADMIN_API_TOKEN}".encode()):
+        raise HTTPException(status_code=401, headers={"WWW-Authenticate": "Bearer"})
+
+@app.get("/admin/stats")
+async def admin_stats(request: Request, event_id: str = None):
+    check_admin_token(request)
+    stats = await registrations.stats()
+    if event_id:
+        return stats.get(event_id) or {}
+    return stats
+
+@app.get("/admin/registrations.csv")
+async def admin_export(request: Request, event_id: str = None):
+    check_admin_token(request)
+    # sync generator: Starlette pulls it in a thread pool, one batch in memory at a time
+    return StreamingResponse(
+        registrations.iter_csv(event_id), media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="registrations-{event_id or "all"}.csv"'},
+    )
+
+@app.get("/queue")
+async def queue_stats():
+    stats = {"mode": "inline"} if update_queue is None else {"mode": "async", **update_queue.stats()}
+    if CBOT_WORKERS > 1:
+        stats["worker"] = CBOT_WORKER_ID
+    if send_scheduler:
+        stats["send"] = send_scheduler.stats()
+    stats["render_cache"] = RENDER_CACHE.stats()
+    stats["duplicate_updates"] = deduper.duplicates
+    return stats
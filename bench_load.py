@@ -0,0 +1,356 @@
+# bench_load.py — offline load test for CBot (no network, no real Telegram)
+#
+# Starts a fake Bot API on localhost (records sendMessage/editMessageText/answerCallbackQuery,
+# can inject latency and 429s), points CBot at it via BOT_API_BASE_URL and replays synthetic
+# registration flows into the webhook endpoint at a given concurrency.
+#
+#   python bench_load.py --flows 200 --concurrency 50
+#   python bench_load.py --flows 200 --api-latency-ms 80 --api-429-rate 0.02 --env SEND_PRIVATE_CHAT_RATE=100
+#   python bench_load.py --target http://127.0.0.1:10000 --api-port 8081   # bot started separately
+#   python bench_load.py --compare bench_results/<older>.json
+#
+# Results (p50/p95/p99 webhook latency, updates/s, outbound calls per flow, memory growth)
+# are printed and saved under bench_results/ so runs can be compared.
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from collections import Counter
+from urllib.parse import parse_qs
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+ADMIN_CHAT_ID = -100777
+ADMIN_USER_ID = 777
+FAKE_TOKEN = "123456:BENCH"
+
+# =========================
+#      FAKE BOT API
+# =========================
+class FakeBotAPI:
+    def __init__(self, latency_ms=0.0, rate_429=0.0, retry_after=1):
+        self.latency = latency_ms / 1000.0
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.throttled = 0
+        self.message_id = 0
+        self.webhook_url = ""
+        self.app = FastAPI()
+        self.app.post("/bot{token}/{method}")(self.handle)
+        self.app.get("/stats")(self.stats)
+
+    async def stats(self):
+        return {"calls": dict(self.calls), "throttled": self.throttled}
+
+    def _message(self, params):
+        self.message_id += 1
+        chat_id = int(params.get("chat_id", 0) or 0)
+        return {
+            "message_id": int(params.get("message_id", 0) or self.message_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "text": params.get("text", ""),
+        }
+
+    async def handle(self, token: str, method: str, request: Request):
+        body = await request.body()
+        if request.headers.get("content-type", "").startswith("application/json"):
+            params = json.loads(body or b"{}")
+        else:
+            params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method not in ("getMe", "setWebhook", "getWebhookInfo", "deleteWebhook") \
+                and self.rate_429 and random.random() < self.rate_429:
+            self.throttled += 1
+            return JSONResponse(status_code=429, content={
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry later",
+                "parameters": {"retry_after": self.retry_after}})
+        self.calls[method] += 1
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+                      "can_join_groups": True, "can_read_all_group_messages": False,
+                      "supports_inline_queries": False}
+        elif method == "getWebhookInfo":
+            result = {"url": self.webhook_url, "has_custom_certificate": False, "pending_update_count": 0}
+        elif method == "setWebhook":
+            self.webhook_url = params.get("url", "")
+            result = True
+        elif method.startswith(("send", "edit")):
+            result = self._message(params)
+        else:
+            result = True
+        return {"ok": True, "result": result}
+
+async def serve(app, port):
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="off"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server, task
+
+# =========================
+#     SYNTHETIC UPDATES
+# =========================
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = 0
+        self.message_id = 0
+
+    def _ids(self):
+        self.update_id += 1
+        self.message_id += 1
+        return self.update_id, self.message_id
+
+    def text(self, user_id, text, chat_id=None):
+        uid, mid = self._ids()
+        chat_id = chat_id or user_id
+        msg = {"message_id": mid, "date": int(time.time()),
+               "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+               "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"},
+               "text": text}
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": uid, "message": msg}
+
+    def callback(self, user_id, data, chat_id=None):
+        uid, mid = self._ids()
+        chat_id = chat_id or user_id
+        return {"update_id": uid, "callback_query": {
+            "id": str(uid), "chat_instance": str(chat_id), "data": data,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"},
+            "message": {"message_id": mid, "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                        "text": "menu"},
+        }}
+
+    def retap(self, update):
+        """The same button pressed again on the same message (a double tap)."""
+        uid, _ = self._ids()
+        cq = dict(update["callback_query"], id=str(uid))
+        return {"update_id": uid, "callback_query": cq}
+
+def registration_flow(f, user_id, ev_id, back_prob, rng, double_tap=0.0):
+    """Full registration as a user would click it, with optional back-navigation and double taps."""
+    steps = [
+        f.text(user_id, "/start"),
+        f.callback(user_id, "list_events"),
+    ]
+    if rng.random() < double_tap:
+        steps.append(f.retap(steps[-1]))
+    steps += [
+        f.callback(user_id, f"event_{ev_id}"),
+        f.callback(user_id, f"register_{ev_id}"),
+        f.callback(user_id, "accept_rules"),
+    ]
+    if rng.random() < back_prob:
+        # name -> back to rules -> accept again
+        steps += [f.callback(user_id, "back_step"), f.callback(user_id, "accept_rules")]
+    steps += [
+        f.text(user_id, f"User {user_id}"),
+        f.text(user_id, f"0912{user_id % 10_000_000:07d}"),
+        f.callback(user_id, rng.choice(["lvl_A", "lvl_B", "lvl_C"])),
+    ]
+    if rng.random() < back_prob:
+        # note -> back to level -> pick again
+        steps += [f.callback(user_id, "back_step"), f.callback(user_id, rng.choice(["lvl_A", "lvl_B", "lvl_C"]))]
+    steps.append(f.text(user_id, "-"))
+    return steps
+
+# =========================
+#         RUNNER
+# =========================
+def pct(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+async def wait_idle(client, timeout=120):
+    """Async webhook mode acks before processing; wait until the bot's queues are drained.
+
+    Returns False if they were still busy after timeout seconds (the run is incomplete).
+    """
+    deadline = time.monotonic() + timeout
+    last = None
+    while time.monotonic() < deadline:
+        try:
+            stats = (await client.get("/queue")).json()
+        except Exception:
+            return True
+        if stats.get("mode") != "async":
+            return True
+        state = (stats.get("depth"), stats.get("processed"), stats.get("failed"),
+                 (stats.get("send") or {}).get("queued"))
+        if state[0] == 0 and not state[3] and state == last:
+            return True
+        last = state
+        await asyncio.sleep(0.2)
+    print(f"warning: bot still busy after {timeout:g}s, result is incomplete", file=sys.stderr)
+    return False
+
+async def run(args, setup=None):
+    """setup: optional coroutine function awaited once the fake API is up (e.g. spawn bot processes)."""
+    rng = random.Random(args.seed)
+    fake = FakeBotAPI(args.api_latency_ms, args.api_429_rate, args.retry_after)
+    api_server, api_task = await serve(fake.app, args.api_port)
+    if setup:
+        await setup()
+
+    lifespan = None
+    if args.target:
+        client = httpx.AsyncClient(base_url=args.target, timeout=60)
+    else:
+        workdir = tempfile.mkdtemp(prefix="cbot-bench-")
+        os.environ.update({
+            "BOT_TOKEN": FAKE_TOKEN,
+            "BOT_API_BASE_URL": f"http://127.0.0.1:{args.api_port}",
+            "GROUP_CHAT_ID": str(ADMIN_CHAT_ID),
+            "CBOT_DB_PATH": os.path.join(workdir, "cbot.sqlite3"),
+            "SHEET_SPOOL_PATH": os.path.join(workdir, "sheet_spool.jsonl"),
+        })
+        os.environ.pop("WEBHOOK_URL", None)
+        for kv in args.env:
+            k, _, v = kv.partition("=")
+            os.environ[k] = v
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import CBot
+        lifespan = CBot.app.router.lifespan_context(CBot.app)
+        await lifespan.__aenter__()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=CBot.app), base_url="http://bot", timeout=60)
+
+    f = UpdateFactory()
+    ev_id = args.event
+    latencies = []
+    errors = Counter()
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def post(update):
+        t0 = time.perf_counter()
+        try:
+            r = await client.post("/", json=update)
+            if r.status_code != 200:
+                errors[r.status_code] += 1
+        except Exception as e:
+            errors[type(e).__name__] += 1
+        latencies.append(time.perf_counter() - t0)
+
+    async def one_flow(n):
+        user_id = 10_000 + n
+        async with sem:
+            for upd in registration_flow(f, user_id, ev_id, args.back_prob, rng, args.double_tap):
+                await post(upd)
+
+    async def one_approval(n):
+        async with sem:
+            await post(f.callback(ADMIN_USER_ID, f"approve_{10_000 + n}_{ev_id}", chat_id=ADMIN_CHAT_ID))
+
+    rss_before = rss_mb()
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one_flow(n) for n in range(args.flows)))
+    t_posted = time.perf_counter() - t0
+    complete = await wait_idle(client, args.idle_timeout)
+    if args.approve:
+        # second phase: admins tap approve once the cards exist (the admin chat is its own shard,
+        # so approvals posted right after a flow could overtake the user's last update)
+        t1 = time.perf_counter()
+        await asyncio.gather(*(one_approval(n) for n in range(args.flows)))
+        t_posted += time.perf_counter() - t1
+        complete = await wait_idle(client, args.idle_timeout) and complete
+    t_total = time.perf_counter() - t0
+    rss_after = rss_mb()
+
+    bot_stats = {}
+    try:
+        bot_stats = (await client.get("/queue")).json()
+    except Exception:
+        pass
+    await client.aclose()
+    if lifespan is not None:
+        await lifespan.__aexit__(None, None, None)
+    api_server.should_exit = True
+    await api_task
+
+    outbound = sum(fake.calls.values())
+    result = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {k: v for k, v in vars(args).items() if k != "compare"},
+        "complete": complete,  # False: timed out waiting for the bot, numbers undercount the work
+        "updates": len(latencies),
+        "errors": dict(errors),
+        "webhook_latency_ms": {p: round(pct(latencies, q) * 1000, 2)
+                               for p, q in (("p50", .50), ("p95", .95), ("p99", .99))},
+        "updates_per_s_ack": round(len(latencies) / t_posted, 1) if t_posted else 0,
+        "updates_per_s_processed": round(len(latencies) / t_total, 1) if t_total else 0,
+        "seconds": round(t_total, 2),
+        "outbound_calls": dict(fake.calls),
+        "outbound_per_flow": round(outbound / args.flows, 2) if args.flows else 0,
+        "api_429_injected": fake.throttled,
+        "rss_mb": {"before": round(rss_before, 1), "after": round(rss_after, 1),
+                   "growth": round(rss_after - rss_before, 1)},
+        "bot": bot_stats,
+    }
+    return result
+
+def compare(new, old):
+    def delta(a, b):
+        return f"{a} (was {b}, {((a - b) / b * 100) if b else 0:+.1f}%)"
+    print("\n--- compared with", old.get("timestamp"))
+    for p in ("p50", "p95", "p99"):
+        print(f"latency {p} ms:", delta(new["webhook_latency_ms"][p], old["webhook_latency_ms"][p]))
+    print("updates/s processed:", delta(new["updates_per_s_processed"], old["updates_per_s_processed"]))
+    print("outbound per flow:", delta(new["outbound_per_flow"], old["outbound_per_flow"]))
+    print("rss growth MB:", delta(new["rss_mb"]["growth"], old["rss_mb"]["growth"]))
+
+def main():
+    ap = argparse.ArgumentParser(description="Offline CBot webhook load test against a fake Bot API")
+    ap.add_argument("--flows", type=int, default=100, help="number of full registration flows (one user each)")
+    ap.add_argument("--concurrency", type=int, default=20, help="flows in flight at once")
+    ap.add_argument("--event", default="m1", help="event id used by the flows")
+    ap.add_argument("--back-prob", type=float, default=0.3, help="chance of a back-navigation detour per step")
+    ap.add_argument("--double-tap", type=float, default=0.0, help="chance of pressing the event list button twice")
+    ap.add_argument("--no-approve", dest="approve", action="store_false", help="skip admin approvals")
+    ap.add_argument("--api-port", type=int, default=8081)
+    ap.add_argument("--api-latency-ms", type=float, default=0.0, help="latency added to every Bot API call")
+    ap.add_argument("--api-429-rate", type=float, default=0.0, help="fraction of calls answered with 429")
+    ap.add_argument("--retry-after", type=int, default=1, help="retry_after sent with injected 429s")
+    ap.add_argument("--target", help="POST to a running bot at this URL instead of importing CBot in-process")
+    ap.add_argument("--env", action="append", default=[], help="extra KEY=VALUE for the in-process bot")
+    ap.add_argument("--idle-timeout", type=float, default=120, help="seconds to wait for the bot to drain its queues")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", default="bench_results", help="directory for the JSON result")
+    ap.add_argument("--compare", help="earlier result JSON to compare against")
+    args = ap.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f"load-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    print("saved", path)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(result, json.load(f))
+    if not result["complete"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
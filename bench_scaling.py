@@ -0,0 +1,131 @@
+# bench_scaling.py — throughput of the multi-process mode (router.py in front of N CBot processes)
+#
+# For each worker count, spawns N `uvicorn CBot:app` processes plus the router (as start.sh does
+# with CBOT_WORKERS=N), replays the bench_load registration flows through the router against the
+# fake Bot API, and reports updates/s and latency per N. Needs as many free cores as workers to
+# show scaling; the load generator and the fake API share this process.
+#
+#   python bench_scaling.py --workers 1,2,4 --flows 400 --concurrency 100
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import httpx
+
+import bench_load
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def spawn(module_app, port, env):
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", module_app, "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=HERE, env=env,
+    )
+
+async def wait_http(url, procs, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=2) as client:
+        while time.monotonic() < deadline:
+            if any(p.poll() is not None for p in procs):
+                raise RuntimeError(f"a bot process exited while waiting for {url}")
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise TimeoutError(url)
+
+async def run_scale(n, args):
+    workdir = tempfile.mkdtemp(prefix=f"cbot-scale{n}-")
+    env = dict(os.environ, **{
+        "BOT_TOKEN": bench_load.FAKE_TOKEN,
+        "BOT_API_BASE_URL": f"http://127.0.0.1:{args.api_port}",
+        "GROUP_CHAT_ID": str(bench_load.ADMIN_CHAT_ID),
+        "CBOT_DB_PATH": os.path.join(workdir, "cbot.sqlite3"),
+        "SHEET_SPOOL_PATH": os.path.join(workdir, "sheet_spool.jsonl"),
+        "CBOT_WORKERS": str(n),
+        "CBOT_WORKER_PORT_BASE": str(args.worker_port_base),
+        # measure CPU scaling, not Telegram's flood limits
+        "SEND_GLOBAL_RATE": "100000", "SEND_PRIVATE_CHAT_RATE": "1000", "SEND_GROUP_CHAT_RATE": "1000",
+    })
+    env.pop("WEBHOOK_URL", None)
+    for kv in args.env:
+        k, _, v = kv.partition("=")
+        env[k] = v
+    procs = []
+
+    async def setup():
+        for i in range(n):
+            procs.append(spawn("CBot:app", args.worker_port_base + i, dict(env, CBOT_WORKER_ID=str(i))))
+        procs.append(spawn("router:app", args.router_port, env))
+        for i in range(n):
+            await wait_http(f"http://127.0.0.1:{args.worker_port_base + i}/", procs)
+        await wait_http(f"http://127.0.0.1:{args.router_port}/", procs)
+
+    load_args = argparse.Namespace(
+        flows=args.flows, concurrency=args.concurrency, event=args.event, back_prob=args.back_prob, double_tap=0.0,
+        approve=True, api_port=args.api_port, api_latency_ms=args.api_latency_ms, api_429_rate=0.0,
+        retry_after=1, target=f"http://127.0.0.1:{args.router_port}", env=[], seed=args.seed,
+        idle_timeout=args.idle_timeout,
+    )
+    try:
+        return await bench_load.run(load_args, setup=setup)
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+def main():
+    ap = argparse.ArgumentParser(description="CBot multi-process scaling benchmark (router + N workers)")
+    ap.add_argument("--workers", default="1,2,4", help="comma separated worker counts")
+    ap.add_argument("--flows", type=int, default=200)
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--event", default="m1")
+    ap.add_argument("--back-prob", type=float, default=0.3)
+    ap.add_argument("--api-port", type=int, default=8091)
+    ap.add_argument("--api-latency-ms", type=float, default=0.0)
+    ap.add_argument("--router-port", type=int, default=10090)
+    ap.add_argument("--worker-port-base", type=int, default=10190)
+    ap.add_argument("--env", action="append", default=[], help="extra KEY=VALUE for the bot processes")
+    ap.add_argument("--idle-timeout", type=float, default=120, help="seconds to wait for the bot to drain its queues")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", default="bench_results")
+    args = ap.parse_args()
+
+    runs = []
+    for n in [int(x) for x in args.workers.split(",") if x]:
+        r = asyncio.run(run_scale(n, args))
+        runs.append({"workers": n, **r})
+        print(f"workers={n}: {r['updates_per_s_processed']} updates/s, "
+              f"p50={r['webhook_latency_ms']['p50']}ms p99={r['webhook_latency_ms']['p99']}ms, errors={r['errors']}"
+              + ("" if r["complete"] else " (INCOMPLETE)"))
+
+    base = runs[0]["updates_per_s_processed"] if runs else 0
+    print(f"\ncpu cores: {os.cpu_count()}")
+    print("workers  updates/s  speedup")
+    for r in runs:
+        speedup = r["updates_per_s_processed"] / base if base else 0
+        print(f"{r['workers']:>7}  {r['updates_per_s_processed']:>9}  {speedup:>6.2f}x")
+
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f"scaling-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"cpu_count": os.cpu_count(), "runs": runs}, f, indent=2, ensure_ascii=False)
+    print("saved", path)
+    if not all(r["complete"] for r in runs):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# bench_tables.py — speed and quality of CBot's table assignment (/tables)
+#
+# Builds synthetic attendee lists with a skewed level mix, simulates a few prior events to
+# get "sat together before" pairs, and times assign_tables with and without local search.
+#
+#   python bench_tables.py --sizes 100,1000,5000,10000 --table-size 6
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("CBOT_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="cbot-tables-"), "cbot.sqlite3"))
+
+from CBot import LEVELS, assign_tables, table_report  # noqa: E402
+
+def attendees(n, rng):
+    levels = list(LEVELS.values())
+    return [(1000 + i, rng.choices(levels, weights=(5, 3, 2))[0]) for i in range(n)]
+
+def prior_pairs(people, table_size, events, rng):
+    """Pairs that shared a table at `events` earlier events, each attended by ~60% of people."""
+    pairs = set()
+    for _ in range(events):
+        seated = [cid for cid, _ in people if rng.random() < 0.6]
+        rng.shuffle(seated)
+        for i in range(0, len(seated), table_size):
+            t = sorted(seated[i:i + table_size])
+            pairs.update((a, b) for j, a in enumerate(t) for b in t[j + 1:])
+    return list(pairs)
+
+def main():
+    ap = argparse.ArgumentParser(description="CBot table assignment benchmark")
+    ap.add_argument("--sizes", default="100,1000,5000,10000")
+    ap.add_argument("--table-size", type=int, default=6)
+    ap.add_argument("--prior-events", type=int, default=3)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    print("people  tables  avoid   greedy_ms  conflicts  search_ms  conflicts  level_dev")
+    for n in [int(x) for x in args.sizes.split(",") if x]:
+        rng = random.Random(args.seed)
+        people = attendees(n, rng)
+        level_of = dict(people)
+        avoid = prior_pairs(people, args.table_size, args.prior_events, rng)
+
+        t0 = time.perf_counter()
+        greedy = assign_tables(people, args.table_size, avoid, rounds=0)
+        greedy_ms = (time.perf_counter() - t0) * 1000
+        t0 = time.perf_counter()
+        tables = assign_tables(people, args.table_size, avoid)
+        search_ms = (time.perf_counter() - t0) * 1000
+
+        g, r = table_report(greedy, level_of, avoid), table_report(tables, level_of, avoid)
+        assert sorted(c for t in tables for c in t) == sorted(level_of), "everyone seated exactly once"
+        assert max(map(len, tables)) <= args.table_size
+        print(f"{n:>6}  {r['tables']:>6}  {len(avoid):>5}  {greedy_ms:>10.1f}  {g['conflicts']:>9}"
+              f"  {search_ms:>9.1f}  {r['conflicts']:>9}  {r['max_level_deviation']:>9}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
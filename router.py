@@ -0,0 +1,102 @@
+# router.py — chat-affinity front for multi-process CBot (start.sh with CBOT_WORKERS > 1)
+#
+# Telegram posts every update here; the raw body is forwarded unchanged to the CBot process
+# that owns the chat (chat_id % CBOT_WORKERS, listening on 127.0.0.1:CBOT_WORKER_PORT_BASE+i).
+# Each user's updates are therefore handled, in order, by one process: the nav stack and
+# per-chat send pacing stay local, shared state (dedup, ledger, send budget) lives in SQLite.
+#
+#   CBOT_WORKERS=4 ./start.sh
+
+import os
+import json
+import asyncio
+from contextlib import asynccontextmanager
+
+import httpx
+from fastapi import FastAPI, Request, Response
+
+CBOT_WORKERS = max(1, int(os.environ.get("CBOT_WORKERS", "1")))
+CBOT_WORKER_PORT_BASE = int(os.environ.get("CBOT_WORKER_PORT_BASE", "10100"))
+ROUTER_TIMEOUT = float(os.environ.get("ROUTER_TIMEOUT", "10"))  # seconds; slower workers get a 503
+
+WORKER_URLS = [f"http://127.0.0.1:{CBOT_WORKER_PORT_BASE + i}" for i in range(CBOT_WORKERS)]
+
+# update types whose payload carries a chat; the rest are routed by sender
+CHAT_KEYS = ("message", "edited_message", "channel_post", "edited_channel_post",
+             "my_chat_member", "chat_member", "chat_join_request")
+
+def update_chat_id(body):
+    for key in CHAT_KEYS:
+        obj = body.get(key)
+        if obj:
+            return obj["chat"]["id"]
+    cq = body.get("callback_query")
+    if cq:
+        msg = cq.get("message")
+        return msg["chat"]["id"] if msg else cq["from"]["id"]
+    for obj in body.values():
+        if isinstance(obj, dict) and "from" in obj:
+            return obj["from"]["id"]
+    return 0
+
+def worker_for(chat_id):
+    # CBot's UpdateQueue shards on (chat_id // CBOT_WORKERS) inside each worker
+    return chat_id % CBOT_WORKERS
+
+client = None
+forwarded = [0] * CBOT_WORKERS
+failed = [0] * CBOT_WORKERS
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client
+    client = httpx.AsyncClient(timeout=ROUTER_TIMEOUT, limits=httpx.Limits(max_connections=64 * CBOT_WORKERS))
+    yield
+    await client.aclose()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.post("/")
+async def webhook(request: Request):
+    body = await request.body()
+    try:
+        chat_id = update_chat_id(json.loads(body))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        chat_id = 0
+    i = worker_for(chat_id)
+    try:
+        r = await client.post(WORKER_URLS[i] + "/", content=body, headers={"content-type": "application/json"})
+    except httpx.HTTPError as e:
+        failed[i] += 1
+        print(f"Router: worker {i} unreachable: {e!r}")
+        # non-2xx makes Telegram redeliver once the worker is back
+        return Response(status_code=503, headers={"Retry-After": "1"})
+    forwarded[i] += 1
+    headers = {"Retry-After": r.headers["retry-after"]} if "retry-after" in r.headers else None
+    return Response(content=r.content, status_code=r.status_code, headers=headers,
+                    media_type=r.headers.get("content-type"))
+
+@app.get("/")
+async def root():
+    return {"status": "CBot router is running.", "workers": CBOT_WORKERS}
+
+@app.get("/queue")
+async def queue_stats():
+    """Per-worker /queue plus totals (same keys as a single CBot process)."""
+    async def one(url):
+        try:
+            return (await client.get(url + "/queue")).json()
+        except (httpx.HTTPError, ValueError):
+            return None
+
+    workers = await asyncio.gather(*(one(url) for url in WORKER_URLS))
+    live = [w for w in workers if w]
+    total = {"mode": "async" if any(w.get("mode") == "async" for w in live) else "inline"}
+    for key in ("depth", "processed", "failed", "rejected", "duplicate_updates"):
+        total[key] = sum(w.get(key, 0) for w in live)
+    total["send"] = {"queued": sum((w.get("send") or {}).get("queued", 0) for w in live)}
+    total["workers"] = [
+        {"worker": i, "forwarded": forwarded[i], "unreachable": failed[i], "stats": w}
+        for i, w in enumerate(workers)
+    ]
+    return total
@@ -1,2 +1,15 @@
 #!/bin/bash
-uvicorn CBot:app --host 0.0.0.0 --port ${PORT:-10000}
+# CBOT_WORKERS > 1: one bot process per core on 127.0.0.1:(CBOT_WORKER_PORT_BASE + i) behind
+# router.py, which sends every chat to the same process (per-user order and nav stay in one place).
+# Needs STATE_BACKEND=sqlite (default): dedup, ledger and send budget are shared through it.
+if [ "${CBOT_WORKERS:-1}" -gt 1 ]; then
+  base=${CBOT_WORKER_PORT_BASE:-10100}
+  for ((i = 0; i < CBOT_WORKERS; i++)); do
+    CBOT_WORKER_ID=$i uvicorn CBot:app --host 127.0.0.1 --port $((base + i)) &
+  done
+  trap 'kill $(jobs -p) 2>/dev/null' EXIT
+  uvicorn router:app --host 0.0.0.0 --port ${PORT:-10000}
+  exit $?
+fi
+# WEB_CONCURRENCY > 1 needs STATE_BACKEND=sqlite (default) so workers share conversation state
+uvicorn CBot:app --host 0.0.0.0 --port ${PORT:-10000} --workers ${WEB_CONCURRENCY:-1}